@@ -0,0 +1,173 @@
+"""Benchmarks for lexing, compiling and rendering misai templates.
+
+Usage:
+    python benchmarks/run.py [-o results.json] [--compare baseline.json] [-w NAME]
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+import misai  # noqa: E402
+
+
+def big_raw():
+    paragraph = '<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit.</p>\n' * 20
+    source = '<html><body>\n{{ title }}\n' + (paragraph + '{{ footer }}\n') * 2000 + '</body></html>'
+    return source, {'title': 'Report', 'footer': '<hr>'}
+
+
+def elif_chain(branches=200):
+    source = '{{ #if n == 0 }}zero'
+    for i in range(1, branches):
+        source += '{{ #elif n == %d }}branch %d' % (i, i)
+    source += '{{ #else }}other{{ #end }}'
+    return source, {'n': branches - 1}
+
+
+def table(rows=10000):
+    source = (
+        '<table>\n'
+        '{{ #for row : rows }}'
+        '<tr><td>{{ row.id }}</td><td>{{ row.name | capitalize }}</td>'
+        '<td>{{ row.email | strip }}</td>'
+        '{{ #if row.active }}<td>yes</td>{{ #else }}<td>no</td>{{ #end }}</tr>\n'
+        '{{ #end }}'
+        '</table>')
+    data = [
+        {'id': i, 'name': 'user %d' % i, 'email': ' user%d@example.com ' % i,
+         'active': i % 3 == 0}
+        for i in range(rows)]
+    return source, {'rows': data}
+
+
+INCLUDE_TEMPLATES = {
+    'page.html': (
+        '<table>{{ #for row : rows }}'
+        '{{ #add "./row.html" row=row }}'
+        '{{ #end }}</table>'),
+    'row.html': (
+        '<tr>{{ #for cell : row }}{{ #add "./cell.html" value=cell }}{{ #end }}</tr>\n'),
+    'cell.html': '<td>{{ value }}</td>',
+}
+
+
+def includes(rows=500, cols=5):
+    return INCLUDE_TEMPLATES['page.html'], {
+        'rows': [['r%dc%d' % (r, c) for c in range(cols)] for r in range(rows)]}
+
+
+WORKLOADS = {
+    'big_raw': big_raw,
+    'elif_chain': elif_chain,
+    'table': table,
+    'includes': includes,
+}
+
+
+def measure(func, min_time=0.2, repeat=3):
+    """Returns the best ops/sec over `repeat` runs of at least `min_time` seconds."""
+    best = 0.0
+    for _ in range(repeat):
+        count, start = 0, time.perf_counter()
+        while True:
+            func()
+            count += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = max(best, count / elapsed)
+    return best
+
+
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_workload(name, loader):
+    source, params = WORKLOADS[name]()
+    if name == 'includes':
+        template = loader.get('page.html')
+    else:
+        template = misai.Template(source)
+
+    phases = {
+        'tokenize': lambda: misai.Lexer(source).tokens,
+        'compile': lambda: misai.Compiler(misai.Lexer(source), mode='render').compile(),
+        'render': lambda: template.render(**params),
+    }
+    results = {}
+    for phase, func in phases.items():
+        results[phase] = {
+            'ops_per_sec': measure(func),
+            'peak_kb': peak_memory(func) / 1024.0,
+        }
+    return results
+
+
+def compare(results, baseline):
+    print('\n{:<12} {:<9} {:>12} {:>12} {:>8}'.format(
+        'workload', 'phase', 'baseline', 'current', 'ratio'))
+    for name, phases in sorted(results.items()):
+        for phase, result in phases.items():
+            base = baseline.get(name, {}).get(phase)
+            if not base:
+                continue
+            print('{:<12} {:<9} {:>12.1f} {:>12.1f} {:>7.2f}x'.format(
+                name, phase, base['ops_per_sec'], result['ops_per_sec'],
+                result['ops_per_sec'] / base['ops_per_sec']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-o', '--output', help='write results as json')
+    parser.add_argument('--compare', help='json results of a previous run')
+    parser.add_argument(
+        '-w', '--workload', action='append', choices=sorted(WORKLOADS),
+        help='run only the given workload (repeatable)')
+    args = parser.parse_args(argv)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for filename, content in INCLUDE_TEMPLATES.items():
+            with open(os.path.join(tmpdir, filename), 'w') as f:
+                f.write(content)
+        loader = misai.Loader(tmpdir)
+
+        results = {}
+        print('{:<12} {:<9} {:>12} {:>12}'.format('workload', 'phase', 'ops/sec', 'peak KiB'))
+        for name in args.workload or sorted(WORKLOADS):
+            results[name] = run_workload(name, loader)
+            for phase, result in results[name].items():
+                print('{:<12} {:<9} {:>12.1f} {:>12.1f}'.format(
+                    name, phase, result['ops_per_sec'], result['peak_kb']))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'misai': misai.__version__,
+                'python': platform.python_version(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
+
+
+if __name__ == '__main__':
+    main()
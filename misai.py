@@ -1,8 +1,27 @@
 import ast
 import collections
+import argparse
+import concurrent.futures
+import copy
+import fnmatch
+import functools
+import hashlib
+import importlib
+import inspect
+import itertools
+import marshal
+import multiprocessing
+import operator
 import os
+import queue
 import re
 import sys
+import threading
+import time
+import types
+
+
+__version__ = '0.1.1'
 
 
 Token = collections.namedtuple('Token', ['type', 'value', 'pos'])
@@ -20,22 +39,19 @@ class astutils:
             args=list(args), keywords=[])
 
     @staticmethod
-    def With(expr, body):
-        return ast.With(items=[ast.withitem(context_expr=expr, optional_vars=None)], body=body)
-
-    @staticmethod
-    def FunctionDef(name, args, body):
+    def FunctionDef(name, args, body, kwonlyargs=()):
         args = [ast.arg(arg=arg, annotation=None) for arg in args]
+        kwonlyargs = [ast.arg(arg=arg, annotation=None) for arg in kwonlyargs]
 
         if sys.version_info[:3] >= (3, 8, 0):
             args = ast.arguments(
                 args=args,
-                kwonlyargs=[], kw_defaults=[], defaults=[],
+                kwonlyargs=kwonlyargs, kw_defaults=[None] * len(kwonlyargs), defaults=[],
                 vararg=None, kwarg=None, posonlyargs=[])
         else:
             args = ast.arguments(
                 args=args,
-                kwonlyargs=[], kw_defaults=[], defaults=[],
+                kwonlyargs=kwonlyargs, kw_defaults=[None] * len(kwonlyargs), defaults=[],
                 vararg=None, kwarg=None)
 
         return ast.FunctionDef(
@@ -44,6 +60,16 @@ class astutils:
             body=body,
             decorator_list=[])
 
+    @staticmethod
+    def AsyncFunctionDef(name, args, body, kwonlyargs=()):
+        node = astutils.FunctionDef(name, args, body, kwonlyargs)
+        return ast.AsyncFunctionDef(
+            **{field: getattr(node, field) for field in node._fields if hasattr(node, field)})
+
+    @staticmethod
+    def Await(func, arg):
+        return ast.Await(astutils.Call(func, arg))
+
 
 class Filters(dict):
     def __call__(self, func):
@@ -59,7 +85,14 @@ class Filters(dict):
 filter = Filters()
 
 
+def foldable(func):
+    """Marks a pure filter that may be evaluated at compile time."""
+    func.foldable = True
+    return func
+
+
 @filter
+@foldable
 def attr(obj, key):
     try:
         return obj[key]
@@ -71,34 +104,84 @@ def attr(obj, key):
         pass
 
 
+def attr_site(key):
+    """Returns `attr` for a constant key, specialized on the types it sees.
+
+    Dicts are subscripted directly, and objects of the last seen type without
+    `__getitem__` skip the failed subscript of the generic `attr`.
+    """
+    cls = None
+    get = operator.attrgetter(key)
+
+    def site(obj):
+        nonlocal cls
+        if type(obj) is dict:
+            try:
+                return obj[key]
+            except KeyError:
+                return attr(obj, key)
+        if type(obj) is cls:
+            try:
+                return get(obj)
+            except AttributeError:
+                return None
+        if not hasattr(type(obj), '__getitem__'):
+            cls = type(obj)
+        return attr(obj, key)
+    return site
+
+
+def missing_filter(name):
+    def call(*args):
+        raise KeyError(name)
+    return call
+
+
 @filter
+@foldable
 def capitalize(string):
     return string.capitalize()
 
 
 @filter
+@foldable
 def strip(string):
     return string.strip()
 
 
 @filter
+@foldable
 def htmlescape(input):
-    if isinstance(input, noescapestr):
-        return input
-    return str(input)\
-        .replace('&', '&amp;')\
-        .replace('<', '&lt;')\
-        .replace('>', '&gt;')\
-        .replace('"', '&#34;')\
-        .replace("'", '&#39;')
+    cls = type(input)
+    if cls is not str:
+        if isinstance(input, noescapestr):
+            return input
+        if cls is int or cls is float or cls is bool:
+            return str(input)
+        input = str(input)
+    # membership tests are much cheaper than replace() on strings that need no escaping
+    if '&' in input:
+        input = input.replace('&', '&amp;')
+    if '<' in input:
+        input = input.replace('<', '&lt;')
+    if '>' in input:
+        input = input.replace('>', '&gt;')
+    if '"' in input:
+        input = input.replace('"', '&#34;')
+    if "'" in input:
+        input = input.replace("'", '&#39;')
+    return input
 
 
 @filter
 def noescape(input):
+    if type(input) is noescapestr:
+        return input
     return noescapestr(input)
 
 
 @filter
+@foldable
 def split(input, delim=None):
     return str(input).split(delim)
 
@@ -118,14 +201,129 @@ class RuntimeError(Exception):
     pass
 
 
+LDELIM = '{{'
+RDELIM = '}}'
+
+COMMENT_RE = re.compile(r'%s#.+?#%s' % (re.escape(LDELIM), re.escape(RDELIM)), re.S)
+
+BLOCK_RULES = [
+    ('rdelim', re.escape(RDELIM)),
+    ('keyword', r'#\w+'),
+    ('colon', r':'),
+    ('dot', r'\.'),
+    ('comma', r','),
+    ('pipe', r'\|'),
+    ('lround', r'\('),
+    ('rround', r'\)'),
+    ('lsquare', r'\['),
+    ('rsquare', r'\]'),
+    ('comp', r'==|!=|<=|>=|<|>'),
+    ('assign', r'='),
+    ('logic', r'\b(?:and|or)\b'),
+    ('float', r'\d+\.\d+\b'),
+    ('int', r'\d+\b'),
+    ('str', r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\''),
+    ('id', r'\b\w+\b'),
+]
+
+# leading whitespace is consumed by the same match instead of a separate token
+BLOCK_RE = re.compile(r'\s*(?:%s)' % '|'.join('(?P<%s>%s)' % rule for rule in BLOCK_RULES))
+
+CLEAN_RIGHT_RE = re.compile(r'[ \t]*\r?\n')
+
+# keywords closed by #end, and those of them with a scope of their own
+BLOCK_KEYWORDS = ('if', 'for', 'cache', 'block', 'macro')
+SCOPE_KEYWORDS = ('for', 'block', 'macro')
+
+EXTENDS_RE = re.compile(r'%s\s*#extends\b' % re.escape(LDELIM))
+
+PRESERVED = ('pre', 'textarea', 'script', 'style')
+# where text ends in the states of minify_html
+MINIFY_TEXT_RE = re.compile(r'<!--|<(%s)\b|<(?=[a-zA-Z/!?])' % '|'.join(PRESERVED), re.I)
+MINIFY_TAG_RE = re.compile(r'["\'>]')
+MINIFY_END_RE = {tag: re.compile(r'</%s\b' % tag, re.I) for tag in PRESERVED}
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+def minify_html(text, state=None):
+    """Collapses whitespace runs in text and tags to a single space.
+
+    Quoted attribute values, comments and the contents of preformatted elements are
+    left alone. Returns the text and the state at its end, to be passed with the next text:
+    None in text, 'tag' inside a tag, a quote inside an attribute value, '!--' inside a
+    comment or the name of the open preformatted element.
+    """
+    chunks = []
+    pos, end = 0, len(text)
+    while pos < end:
+        if state is None or state == 'tag':
+            m = (MINIFY_TEXT_RE if state is None else MINIFY_TAG_RE).search(text, pos)
+            stop = m.start() if m else end
+            chunks.append(WHITESPACE_RE.sub(' ', text[pos:stop]))
+            if m is None:
+                break
+            chunks.append(m.group())
+            pos = m.end()
+            if state == 'tag':
+                state = None if m.group() == '>' else m.group()
+            elif m.group() == '<!--':
+                state = '!--'
+            else:
+                state = m.group(1).lower() if m.group(1) else 'tag'
+            continue
+
+        # kept as is up to the end of the comment, element or attribute value
+        if state == '!--':
+            found = text.find('-->', pos)
+            stop, after = (found + 3, None) if found != -1 else (end, state)
+        elif state in PRESERVED:
+            m = MINIFY_END_RE[state].search(text, pos)
+            stop, after = (m.end(), 'tag') if m else (end, state)
+        else:
+            found = text.find(state, pos)
+            stop, after = (found + 1, 'tag') if found != -1 else (end, state)
+        chunks.append(text[pos:stop])
+        pos, state = stop, after
+    return ''.join(chunks), state
+
+
 class Lexer:
-    def __init__(self, source, cleanlines=True):
+    """Produces tokens lazily, cleaning the lines of standalone keyword tags on the fly.
+
+    Tokens are kept as (type, pos, value) tuples until they are handed out, with the
+    value of raw text being its end offset in the source rather than a substring.
+    """
+
+    def __init__(self, source, cleanlines=True, minify=False, minify_state=None):
         self.source = source
+        self.cleanlines = cleanlines
+        self.minify = minify
+        # minify_html state the source starts in, and the one after the last raw text
+        self.minify_start = self.minify_state = minify_state
         self.cache = collections.deque()
-        self.tokens = list(self.tokenize())
-        if cleanlines:
-            self.clean(self.tokens)
-        self.idx = 0
+        self.stream = self.compact_tokens()
+        self.eof = Token('eof', None, len(source))
+        self.line_pos, self.lineno = 0, 1
+
+    @property
+    def tokens(self):
+        """All tokens of the source, regardless of how many were consumed."""
+        return [self.token(t) for t in self.compact_tokens()]
+
+    def token(self, compact):
+        type, pos, value = compact
+        if type == 'raw' and value.__class__ is int:
+            value = self.source[pos:value]
+        return Token(type, value, pos)
+
+    def position(self, pos):
+        """Returns the line and column of an offset, counting lines from the previous offset."""
+        if pos < self.line_pos:
+            self.lineno -= self.source.count('\n', pos, self.line_pos)
+        else:
+            self.lineno += self.source.count('\n', self.line_pos, pos)
+        self.line_pos = pos
+        return self.lineno, pos - self.source.rfind('\n', 0, pos) - 1
 
     def consume(self, token_type, token_value=None):
         token = self.next()
@@ -148,178 +346,389 @@ class Lexer:
         return lookup.type == token_type
 
     def lookup(self, offset=0):
-        return self.tokens[self.idx]
+        while len(self.cache) <= offset:
+            compact = next(self.stream, None)
+            if compact is None:
+                return self.eof
+            self.cache.append(self.token(compact))
+        return self.cache[offset]
 
     def next(self):
-        i, self.idx = self.idx, self.idx + 1
-        if i >= len(self.tokens):
-            return Token('eof', None, None)
-        return self.tokens[i]
+        if self.cache:
+            return self.cache.popleft()
+        compact = next(self.stream, None)
+        if compact is None:
+            return self.eof
+        return self.token(compact)
+
+    def compact_tokens(self):
+        tokens = self.tokenize()
+        if self.cleanlines:
+            tokens = self.clean(tokens)
+        if self.minify:
+            tokens = self.minified(tokens, self.minify_start)
+        return tokens
+
+    def minified(self, tokens, state):
+        # raw text is minified as one document, tags in between do not change the state
+        for token in tokens:
+            if token[0] == 'raw':
+                type, pos, value = token
+                if value.__class__ is int:
+                    value = self.source[pos:value]
+                value, state = minify_html(value, state)
+                self.minify_state = state
+                token = (type, pos, value)
+            yield token
 
     def clean(self, tokens):
-        il, ir = None, None
-        for i in range(len(tokens)):
-            if tokens[i].type == 'ldelim':
-                il = i
-            elif tokens[i].type == 'rdelim':
-                ir = i
-
-                if not il or tokens[il + 1].type != 'keyword':
-                    il, ir = None, None
-                    continue
+        # holds back the raw text before a tag until the token after it is known
+        before, pending, first = None, None, True
+        while True:
+            if pending is not None:
+                token, pending = pending, None
+            else:
+                token = next(tokens, None)
+                if token is None:
+                    break
+            if token[0] == 'raw':
+                if before is not None:
+                    yield before
+                before, first = token, False
+                continue
 
-                m_l = (il == 0) \
-                    or (tokens[il - 1].type == 'raw'
-                        and re.search('(^|\n|\r\n)[ \t]*$', tokens[il - 1].value))
-                m_r = (ir == len(tokens) - 1) \
-                    or (tokens[ir + 1].type == 'raw'
-                        and re.search('^[ \t]*(\n|\r\n)', tokens[ir + 1].value))
-
-                if m_l and m_r:
-                    if il != 0:
-                        oldtoken = tokens[il - 1]
-                        newvalue = re.sub('[ \t]*$', '', oldtoken.value)
-                        newtoken = Token('raw', newvalue, oldtoken.pos)
-                        tokens[il - 1] = newtoken
-                    if ir != len(tokens) - 1:
-                        oldtoken = tokens[ir + 1]
-                        newvalue = re.sub('^[ \t]*(\n|\r\n)', '', oldtoken.value)
-                        newtoken = Token('raw', newvalue, oldtoken.pos)
-                        tokens[ir + 1] = newtoken
+            tag = [token]
+            for token in tokens:
+                tag.append(token)
+                if token[0] == 'rdelim':
+                    break
+            after = next(tokens, None)
+            # a tag at the very start of the template is left alone
+            if not first and before is not None and len(tag) > 2 \
+                    and tag[1][0] == 'keyword' and tag[-1][0] == 'rdelim':
+                before, after = self.strip_line(before, after)
+            first = False
+
+            if before is not None:
+                yield before
+                before = None
+            yield from tag
+            if after is not None:
+                if after[0] == 'raw':
+                    before = after
+                else:
+                    pending = after
+        if before is not None:
+            yield before
+
+    def strip_line(self, before, after):
+        """Removes the indentation before a tag and the line break after it, if both are there."""
+        source = self.source
+        _, start, end = before
+        stripped = end
+        while stripped > start and source[stripped - 1] in ' \t':
+            stripped -= 1
+        if stripped > start and source[stripped - 1] != '\n':
+            return before, after
+        if after is not None:
+            m = after[0] == 'raw' and CLEAN_RIGHT_RE.match(source, after[1], after[2])
+            if not m:
+                return before, after
+            after = ('raw', m.end(), after[2])
+        if stripped < end:
+            before = ('raw', start, stripped)
+        elif end > start and source[end - 1] == '\n':
+            # like `[ \t]*$`, also strips blanks before a final line break
+            blank = end - 1
+            while blank > start and source[blank - 1] in ' \t':
+                blank -= 1
+            if blank < end - 1:
+                before = ('raw', start, source[start:blank] + '\n')
+        return before, after
 
     def tokenize(self):
-        c = re.compile
-        ldelim = '{{'
-        rdelim = '}}'
-        esc_ldelim = re.escape(ldelim)
-        esc_rdelim = re.escape(rdelim)
-        rules = {
-            'root': [
-                (c(r'%s#.+?#%s' % (esc_ldelim, esc_rdelim), re.S), 'comment'),
-                (c(r'(.*?)' + esc_ldelim, re.S), 'ldelim'),
-                (c(r'(.+)', re.S), 'raw'),
-            ],
-            'block': [
-                (c(esc_rdelim), 'rdelim'),
-                (c(r'\s+'), 'ws'),
-
-                # keyword
-                (c(r'#(\w+)'), 'keyword'),
-
-                (c(r':'), 'colon'),
-                (c(r'\.'), 'dot'),
-                (c(r','), 'comma'),
-                (c(r'\|'), 'pipe'),
-                (c(r'\('), 'lround'),
-                (c(r'\)'), 'rround'),
-                (c(r'\['), 'lsquare'),
-                (c(r'\]'), 'rsquare'),
-                (c(r'==|!=|<=|>=|<|>'), 'comp'),
-                (c(r'='), 'assign'),
-                (c(r'\b(and|or)\b'), 'logic'),
-
-                # literals
-                (c(r'\d+\.\d+\b'), 'float'),
-                (c(r'\d+\b'), 'int'),
-                (c(r'"(([^"\\]|\\.)*)"'), 'str'),
-                (c(r"'(([^'\\]|\\.)*)'"), 'str'),
-                (c(r'\b(\w+)\b'), 'id'),
-            ]
-        }
-        inside_delim = False
+        source = self.source
+        end = len(source)
         pos = 0
-        while pos < len(self.source):
-            for regex, name in rules['block' if inside_delim else 'root']:
-                m = regex.match(self.source, pos)
-                if not m:
-                    continue
-
-                if pos == m.end() and name != 'ldelim':
-                    # should not never happen
-                    msg = '{} yielded empty string'.format(regex)
-                    raise TemplateSyntaxError(msg)
-
-                pos_prev, pos = pos, m.end()
-                name = name or m.group()
-                match = m.group(1) if m.groups() else m.group()
-
-                if inside_delim:
-                    if name == 'ws':
-                        break
-
-                    value = match
-                    if name == 'rdelim':
-                        inside_delim = False
-                    elif name == 'int':
-                        value = int(match)
-                    elif name == 'float':
-                        value = float(match)
-                    elif name == 'str':
-                        value = match\
-                            .replace(r'\"', '"')\
-                            .replace(r"\'", "'")
-
-                    yield Token(name, value, pos_prev)
+        while pos < end:
+            start = source.find(LDELIM, pos)
+            if start < 0:
+                yield ('raw', pos, end)
+                break
+            if start > pos:
+                yield ('raw', pos, start)
+            m = COMMENT_RE.match(source, start)
+            if m:
+                pos = m.end()
+                continue
+            yield ('ldelim', start, LDELIM)
+            pos = start + len(LDELIM)
 
+            match = BLOCK_RE.scanner(source, pos).match
+            while True:
+                m = match()
+                if not m:
+                    rest = source[pos:]
+                    pos += len(rest) - len(rest.lstrip())
+                    if pos >= end:
+                        return
+                    msg = 'unexpected char {}'.format(repr(source[pos]))
+                    raise TemplateSyntaxError(msg, pos=pos, source=source)
+                name = m.lastgroup
+                value = m.group(name)
+                if name == 'keyword':
+                    value = value[1:]
+                elif name == 'int':
+                    value = int(value)
+                elif name == 'float':
+                    value = float(value)
+                elif name == 'str':
+                    value = value[1:-1]\
+                        .replace(r'\"', '"')\
+                        .replace(r"\'", "'")
+                yield (name, m.start(name), value)
+                pos = m.end()
+                if name == 'rdelim':
                     break
-                else:
-                    if name == 'comment':
-                        break
-                    elif name == 'ldelim':
-                        if len(match) > 0:
-                            yield Token('raw', match, pos)
-                        yield Token('ldelim', ldelim, pos - len(ldelim))
-                        inside_delim = True
-                    else:
-                        yield Token(name, match, pos)
-                    break
-            else:
-                msg = 'unexpected char {}'.format(repr(self.source[pos]))
-                raise TemplateSyntaxError(msg, pos=pos, source=self.source)
-
-
-class Context:
-    def __init__(self, values):
-        self.scopes = [values]
 
-    def __setitem__(self, key, value):
-        self.scopes[-1][key] = value
 
-    def __getitem__(self, key):
-        for i in range(len(self.scopes) - 1, -1, -1):
-            if key in self.scopes[i]:
-                return self.scopes[i][key]
+class lazy:
+    """Marks a context value that is computed by calling `func` when it is first used."""
+
+    __slots__ = ('func',)
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self):
+        return self.func()
+
+
+class Context(dict):
+    def __init__(self, values, defaults=None):
+        super().__init__(values)
+        self.defaults = defaults
+        self.lazy = None
+        # lazy values are kept aside so that only their first lookup goes through __missing__
+        for key, value in values.items():
+            if value.__class__ is lazy:
+                if self.lazy is None:
+                    self.lazy = {}
+                self.lazy[key] = value
+        if self.lazy is not None:
+            for key in self.lazy:
+                del self[key]
+
+    def __missing__(self, key):
+        if self.lazy is not None and key in self.lazy:
+            value = self[key] = self.lazy.pop(key)()
+            return value
+        if self.defaults is not None and key in self.defaults:
+            value = self.defaults[key]
+            if value.__class__ is lazy:
+                value = self[key] = value()
+            return value
         raise IndexError(key)
 
-    def __enter__(self):
-        return self
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        self.scopes.pop()
-
-    def __call__(self, values):
-        self.scopes.append(values)
-        return self
+    def deferred(self, key, resolve=None):
+        """Returns the value of `key`, or a lazy lookup if it was not computed yet.
+
+        The lookup is `resolve(context, key)` if given, async templates await with it.
+        """
+        if self.lazy is not None and key in self.lazy or key not in self \
+                and self.defaults is not None and self.defaults.get(key).__class__ is lazy:
+            if resolve is not None:
+                return lazy(functools.partial(resolve, self, key))
+            return lazy(functools.partial(self.__getitem__, key))
+        return self[key]
+
+
+class Scope:
+    def __init__(self, parent=None, context=None):
+        self.parent = parent
+        self.context = context or parent.context
+        self.names = {}
+        self.maybe_unset = set()
+        # names set at depth 0, unassigned until their #set runs
+        self.unassigned = set()
+        self.prelude = []
+        self.depth = 0
+        self.function = False
+
+
+async def auto_await(value):
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+async def auto_await_key(context, key):
+    # awaited values replace the awaitable so later references reuse the result
+    value = context[key]
+    if inspect.isawaitable(value):
+        value = context[key] = await value
+    return value
+
+
+async def auto_await_deferred(context, key):
+    # like auto_await_key, but lazy values not computed yet are passed on as they are
+    value = context.deferred(key, auto_await_key)
+    if value.__class__ is not lazy and inspect.isawaitable(value):
+        value = context[key] = await value
+    return value
+
+
+async def auto_aiter(iterable):
+    if hasattr(iterable, '__aiter__'):
+        async for item in iterable:
+            yield item
+    else:
+        for item in iterable:
+            yield item
+
+
+class LoopContext:
+    """The `loop` variable of a #for body.
+
+    It is updated in place while iterating; `last` looks one item ahead and
+    `length` is None for iterables without a length. Inside a loop body `loop`
+    hides a context value of the same name, unless it is the loop target itself.
+    """
+
+    __slots__ = ('iterable', 'length', 'index0', 'first', 'last')
+
+    def __init__(self, iterable):
+        self.iterable = iterable
+        self.length = len(iterable) if hasattr(iterable, '__len__') else None
+        self.index0 = 0
+        self.first = True
+        self.last = False
+
+    @property
+    def index(self):
+        return self.index0 + 1
+
+    @property
+    def even(self):
+        return self.index0 % 2 == 1
+
+    @property
+    def odd(self):
+        return self.index0 % 2 == 0
+
+    def __iter__(self):
+        items = iter(self.iterable)
+        for item in items:
+            break
+        else:
+            return
+        index = 0
+        for following in items:
+            self.index0, self.first = index, index == 0
+            yield item
+            item, index = following, index + 1
+        self.index0, self.first, self.last = index, index == 0, True
+        yield item
+
+    async def __aiter__(self):
+        items = auto_aiter(self.iterable).__aiter__()
+        try:
+            item = await items.__anext__()
+        except StopAsyncIteration:
+            return
+        index = 0
+        async for following in items:
+            self.index0, self.first = index, index == 0
+            yield item
+            item, index = following, index + 1
+        self.index0, self.first, self.last = index, index == 0, True
+        yield item
+
+
+def join_chunks(chunks, encoding):
+    # output of includes is already encoded when rendering bytes
+    return ''.join([
+        chunk.decode(encoding) if chunk.__class__ is bytes else chunk for chunk in chunks])
+
+
+# helpers referenced by name from generated code
+runtime = {
+    'auto_await': auto_await,
+    'auto_await_key': auto_await_key,
+    'auto_await_deferred': auto_await_deferred,
+    'auto_aiter': auto_aiter,
+    'Context': Context,
+    'LoopContext': LoopContext,
+    'join_chunks': join_chunks,
+    'noescapestr': noescapestr,
+}
 
 
 class Compiler:
-    def __init__(self, lexer, filename='<string>'):
+    def __init__(self, lexer, filename='<string>', mode='stream', formatter=None, filters=None,
+                 profile=False, name=None, encoding='utf-8', loader=None, filepath=None,
+                 inline_includes=False, cleanlines=True, minify=False):
         self.lexer = lexer
         self.filename = filename
+        self.name = name or filename
+        self.loader = loader
+        self.filepath = filepath
+        self.inline_includes = inline_includes and loader is not None
+        self.cleanlines = cleanlines
+        self.minify = minify
+        self.inlining = [filename]
+        self.dependencies = set()
+        self.includes = set()
+        # filters and attr call sites bound by the template as keyword-only arguments
+        self.bound = []
+        # template inheritance: the pending #extends, whether the source has one,
+        # overridden blocks by name
+        self.extends = None
+        self.extending = False
+        self.blocks = {}
+        self.block_depth = 0
+        self.location = None
+        # macro function names and imported macros by namespace
+        self.macros = set()
+        self.namespaces = {}
+        self.mode = mode
+        self.encoding = encoding
+        self.is_async = mode == 'async'
+        self.profile = profile
+        self.formatter = formatter
+        self.filters = filter if filters is None else filters
         self.funcname = 'root'
         self.varcount = -1
+        self.scope = None
 
         self.param_context = 'context'
+        self.context_names = {self.param_context}
         self.param_tostr = 'tostr'
         self.param_filters = 'filters'
         self.param_getattr = 'attr'
         self.param_loader = 'load'
+        self.param_fragments = 'fragment_cache'
+        self.var_buffer = 'buf'
+        self.var_write = 'write'
+        self.var_extend = 'extend'
+        self.var_chunk = 'chunk'
+        self.func_await = 'auto_await'
+        self.func_await_key = 'auto_await_key'
+        self.func_await_deferred = 'auto_await_deferred'
+        self.func_aiter = 'auto_aiter'
+        self.func_probe = 'probe'
+        self.func_clock = 'clock'
 
         self.keyword_handlers = {
             'set': self.assign,
             'if': self.cond,
             'for': self.loop,
-            'add': self.include}
+            'add': self.include,
+            'cache': self.fragment,
+            'extends': self.extend,
+            'block': self.block,
+            'macro': self.macro,
+            'import': self.import_}
         self.comp_map = {
             '==': ast.Eq,
             '!=': ast.NotEq,
@@ -328,55 +737,489 @@ class Compiler:
             '<': ast.Lt,
             '>': ast.Gt,}
 
+    def locate(self, node, pos):
+        """Sets the template position on the node and its children that have none yet."""
+        lineno, col_offset = self.location or self.lexer.position(pos)
+        for child in ast.walk(node):
+            if 'lineno' in child._attributes and getattr(child, 'lineno', None) is None:
+                child.lineno = child.end_lineno = lineno
+                child.col_offset = child.end_col_offset = col_offset
+        return node
+
+    def awaited(self, node):
+        if not self.is_async:
+            return node
+        if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) \
+                and node.value.id in self.context_names:
+            key = node.slice.value if isinstance(node.slice, ast.Index) else node.slice
+            return ast.Await(astutils.Call(
+                self.func_await_key, ast.Name(node.value.id, ast.Load()), key))
+        return astutils.Await(self.func_await, node)
+
+    def deferred(self, node):
+        """Turns a context lookup into one that keeps lazy values pending."""
+        if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) \
+                and node.value.id in self.context_names:
+            key = node.slice.value if isinstance(node.slice, ast.Index) else node.slice
+            return ast.Call(
+                func=ast.Attribute(node.value, 'deferred', ast.Load()), args=[key], keywords=[])
+        # the async form built by awaited()
+        if isinstance(node, ast.Await) and isinstance(node.value, ast.Call) \
+                and isinstance(node.value.func, ast.Name) \
+                and node.value.func.id == self.func_await_key:
+            return ast.Await(astutils.Call(self.func_await_deferred, *node.value.args))
+        return node
+
     def _unique_name(self):
         self.varcount += 1
         return 'var' + str(self.varcount)
 
+    def lookup(self, name):
+        return self.resolve(name, self.scope, self.scope.context)
+
+    def resolve(self, name, scope, context):
+        nested = False
+        while scope is not None:
+            if name in scope.names:
+                varname = scope.names[name]
+                if nested and varname in scope.unassigned:
+                    # a macro can be called before a name it uses is set
+                    scope.unassigned.discard(varname)
+                    scope.maybe_unset.add(varname)
+                    scope.prelude.append(ast.Assign(
+                        [ast.Name(varname, ast.Store())], ast.Name(scope.context, ast.Load())))
+                node = ast.Name(varname, ast.Load())
+                if varname in scope.maybe_unset:
+                    # the context itself marks a name that may not be set yet
+                    node = ast.IfExp(
+                        ast.Compare(node, [ast.Is()], [ast.Name(scope.context, ast.Load())]),
+                        self.resolve(name, scope.parent, scope.context),
+                        node)
+                return node
+            nested = nested or scope.function
+            scope = scope.parent
+        return ast.Subscript(
+            ast.Name(context, ast.Load()),
+            ast.Index(ast.Constant(name)),
+            ast.Load())
+
+    def declare(self, name):
+        varname = self.scope.names[name] = self._unique_name()
+        return varname
+
+    def bind(self, name):
+        scope = self.scope
+        if name in scope.names:
+            return scope.names[name]
+        if scope.depth == 0:
+            varname = self.declare(name)
+            scope.unassigned.add(varname)
+            return varname
+
+        # conditionally set names start out as the outer value
+        outer = self.resolve(name, scope.parent, scope.context)
+        varname = self.declare(name)
+        if isinstance(outer, ast.Name):
+            scope.prelude.append(ast.Assign([ast.Name(varname, ast.Store())], outer))
+        else:
+            scope.maybe_unset.add(varname)
+            scope.prelude.append(ast.Assign(
+                [ast.Name(varname, ast.Store())],
+                ast.Name(scope.context, ast.Load())))
+        return varname
+
+    def push_scope(self, context=None):
+        self.scope = Scope(self.scope, context)
+
+    def pop_scope(self, body):
+        scope, self.scope = self.scope, self.scope.parent
+        return scope.prelude + body
+
     def include(self):
-        path = self.lexer.consume('str').value
+        token = self.lexer.consume('str')
+        path = token.value
         keys, values = [], []
         while self.lexer.next_is('id'):
-            keys.append(ast.Str(s=self.lexer.consume('id').value))
+            keys.append(self.lexer.consume('id').value)
             self.lexer.consume('assign')
             values.append(self.expr())
         self.lexer.consume('rdelim')
+        if self.loader is not None:
+            relpath, fullpath = self.loader.resolve(path, self.filepath)
+            self.includes.add(fullpath)
+            # recursive includes and templates extending another one are left to runtime
+            if self.inline_includes and fullpath not in self.inlining:
+                source = self.loader.read(relpath, fullpath)
+                if not EXTENDS_RE.search(source):
+                    return self.inline(relpath, fullpath, source, keys, values, token.pos)
+        # lazy values passed on by name are only computed if the included template uses them
+        values = [self.deferred(value) for value in values]
         call = astutils.Call(
-            self.param_loader, ast.Str(s=path), ast.Dict(keys=keys, values=values))
-        return ast.Expr(ast.Yield(call))
+            self.param_loader, ast.Constant(path),
+            ast.Dict(keys=[ast.Constant(key) for key in keys], values=values))
+        if self.is_async:
+            return ast.AsyncFor(
+                ast.Name(self.var_chunk, ast.Store()), call,
+                [ast.Expr(ast.Yield(ast.Name(self.var_chunk, ast.Load())))], [])
+        return ast.Expr(ast.YieldFrom(call))
+
+    def inline(self, relpath, fullpath, source, keys, values, pos):
+        """Compiles the included template in place, with its parameters as locals."""
+        self.dependencies.add((relpath, fullpath))
+        context = self._unique_name()
+        self.context_names.add(context)
+        body = [
+            ast.Assign([ast.Name(self._unique_name(), ast.Store())], value)
+            for value in values]
+
+        saved = self.lexer, self.scope, self.filepath, self.name
+        # blocks of the included template are its own, not overrides of the includer
+        inheritance = self.extends, self.extending, self.blocks, self.block_depth
+        # the included text continues the includer's, e.g. inside a <pre> element
+        self.lexer = Lexer(source, self.cleanlines, self.minify, self.lexer.minify_state)
+        self.scope, self.filepath, self.name = None, relpath, relpath
+        self.extends, self.blocks, self.block_depth = None, {}, 0
+        self.inlining.append(fullpath)
+        try:
+            self.push_scope(context)
+            for key, assign in zip(keys, body):
+                self.scope.names[key] = assign.targets[0].id
+            self.prepare()
+            body += self.pop_scope(self.nodelist())
+        finally:
+            self.inlining.pop()
+            self.lexer, self.scope, self.filepath, self.name = saved
+            self.extends, self.extending, self.blocks, self.block_depth = inheritance
+
+        # free names of the included template only see the template locals
+        if any(isinstance(node, ast.Name) and node.id == context
+               for stmt in body for node in ast.walk(stmt)):
+            body.insert(0, ast.Assign([ast.Name(context, ast.Store())], astutils.Call(
+                'Context', ast.Dict([], []),
+                ast.Attribute(ast.Name(self.scope.context, ast.Load()), 'defaults', ast.Load()))))
+
+        for stmt in body:
+            for node in ast.walk(stmt):
+                if 'lineno' in node._attributes:
+                    node.lineno = None
+        # errors inside the included template point at the include tag
+        return [self.locate(stmt, pos) for stmt in body]
+
+    def extend(self):
+        token = self.lexer.consume('str')
+        self.lexer.consume('rdelim')
+        if self.loader is None:
+            raise TemplateSyntaxError(
+                '#extends requires a loader', source=self.lexer.source, pos=token.pos)
+        if self.scope.parent is not None or self.scope.depth or self.block_depth:
+            raise TemplateSyntaxError(
+                '#extends must be at the top level', source=self.lexer.source, pos=token.pos)
+        self.extends = token
+        return []
+
+    def block(self):
+        name = self.lexer.consume('id').value
+        self.lexer.consume('rdelim')
+        # top level blocks of an extending template only override the parent's
+        overriding = self.extending and self.block_depth == 0
+        if overriding:
+            self.push_scope()
+        self.block_depth += 1
+        body = self.nodelist(until=['end'])
+        self.block_depth -= 1
+        self.lexer.consume('keyword', 'end')
+        self.lexer.consume('rdelim')
+        if overriding:
+            body = self.pop_scope(body)
+            # the most derived template comes first
+            self.blocks.setdefault(name, body)
+            return []
+        if name in self.blocks:
+            return copy.deepcopy(self.blocks[name])
+        return body
+
+    def inherit(self, body):
+        """Compiles the chain of parents of an extending template into one body."""
+        self.location = self.lexer.position(self.extends.pos)
+        saved = self.lexer, self.scope, self.filepath, self.name
+        depth = len(self.inlining)
+        # output outside of the blocks of extending templates is dropped, the rest is kept
+        kept = []
+        try:
+            while self.extends is not None:
+                kept += [
+                    stmt for stmt in body
+                    if not any(isinstance(node, (ast.Yield, ast.YieldFrom))
+                               for node in ast.walk(stmt))]
+                token, self.extends = self.extends, None
+                relpath, fullpath = self.loader.resolve(token.value, self.filepath)
+                if fullpath in self.inlining:
+                    raise TemplateSyntaxError(
+                        'recursive #extends of {}'.format(token.value),
+                        source=self.lexer.source, pos=token.pos)
+                source = self.loader.read(relpath, fullpath)
+                self.dependencies.add((relpath, fullpath))
+                self.includes.add(fullpath)
+                self.inlining.append(fullpath)
+                self.lexer = Lexer(source, self.cleanlines, self.minify)
+                self.scope, self.filepath, self.name = None, relpath, relpath
+                self.push_scope(self.param_context)
+                self.prepare()
+                body = self.pop_scope(self.nodelist())
+        finally:
+            del self.inlining[depth:]
+            self.lexer, self.scope, self.filepath, self.name = saved
+            self.location = None
+        return kept + body
+
+    def macro(self):
+        token = self.lexer.consume('id')
+        self.lexer.consume('lround')
+        params = []
+        while self.lexer.next_is('id'):
+            params.append(self.lexer.next().value)
+            if not self.lexer.next_is('comma'):
+                break
+            self.lexer.next()
+        self.lexer.consume('rround')
+        self.lexer.consume('rdelim')
+
+        funcname = self.scope.names.get(token.value)
+        if funcname not in self.macros:
+            funcname = self.declare(token.value)
+            self.macros.add(funcname)
+        self.push_scope()
+        self.scope.function = True
+        args = [self.declare(param) for param in params]
+        body = self.pop_scope(self.nodelist(until=['end']))
+        self.lexer.consume('keyword', 'end')
+        self.lexer.consume('rdelim')
+
+        # macros build a string like render mode does and return it as markup
+        chunks, write, extend = self._unique_name(), self._unique_name(), self._unique_name()
+        body = [
+            ast.Assign([ast.Name(chunks, ast.Store())], ast.List([], ast.Load())),
+            ast.Assign(
+                [ast.Name(write, ast.Store())],
+                ast.Attribute(ast.Name(chunks, ast.Load()), 'append', ast.Load())),
+            ast.Assign(
+                [ast.Name(extend, ast.Store())],
+                ast.Attribute(ast.Name(chunks, ast.Load()), 'extend', ast.Load())),
+        ] + self.appendlist(body, write, extend) + [
+            ast.Return(astutils.Call('noescapestr', self.joined(chunks))),
+        ]
+        function = astutils.AsyncFunctionDef if self.is_async else astutils.FunctionDef
+        # definitions are hoisted so that macros can be called before them
+        self.scope.prelude.append(self.locate(function(funcname, args, body), token.pos))
+        return []
+
+    def prepare(self):
+        """Scans the current source for tags that apply before their position: the macros
+        defined in its scope are declared so they can be called before their definition, and
+        an #extends makes blocks ahead of it overrides too."""
+        source = self.lexer.source
+        self.extending = False
+        if '#macro' not in source and '#extends' not in source:
+            return
+        tokens = Lexer(source, cleanlines=False).tokens
+        # open tags, and how many of them start a scope of their own
+        opened, depth = [], 0
+        for token, following in zip(tokens, tokens[1:] + [self.lexer.eof]):
+            if token.type != 'keyword':
+                continue
+            if token.value == 'extends':
+                self.extending = True
+            elif token.value == 'end' and opened:
+                depth -= opened.pop() in SCOPE_KEYWORDS
+            elif token.value in BLOCK_KEYWORDS:
+                if token.value == 'macro' and depth == 0 and following.type == 'id' \
+                        and following.value not in self.scope.names:
+                    self.macros.add(self.declare(following.value))
+                opened.append(token.value)
+                depth += token.value in SCOPE_KEYWORDS
+
+    def import_(self):
+        token = self.lexer.consume('str')
+        self.lexer.consume('id', 'as')
+        namespace = self.lexer.consume('id').value
+        self.lexer.consume('rdelim')
+        if self.loader is None:
+            raise TemplateSyntaxError(
+                '#import requires a loader', source=self.lexer.source, pos=token.pos)
+        if self.scope.parent is not None or self.scope.depth or self.block_depth:
+            raise TemplateSyntaxError(
+                '#import must be at the top level', source=self.lexer.source, pos=token.pos)
+        relpath, fullpath = self.loader.resolve(token.value, self.filepath)
+        if fullpath in self.inlining:
+            raise TemplateSyntaxError(
+                'recursive #import of {}'.format(token.value),
+                source=self.lexer.source, pos=token.pos)
+        source = self.loader.read(relpath, fullpath)
+        self.dependencies.add((relpath, fullpath))
+        self.includes.add(fullpath)
+
+        # only the macros of the imported template are compiled in
+        saved = self.lexer, self.scope, self.filepath, self.name, self.location
+        inheritance = self.extends, self.extending, self.blocks, self.block_depth
+        self.location = self.location or self.lexer.position(token.pos)
+        self.lexer = Lexer(source, self.cleanlines, self.minify)
+        self.scope = Scope(None, self.scope.context)
+        self.filepath, self.name = relpath, relpath
+        self.extends, self.blocks, self.block_depth = None, {}, 0
+        self.inlining.append(fullpath)
+        try:
+            self.prepare()
+            self.nodelist()
+            if self.extends is not None:
+                raise TemplateSyntaxError(
+                    '#extends in imported template {}'.format(relpath),
+                    source=self.lexer.source, pos=self.extends.pos)
+            imported = self.scope
+        finally:
+            self.inlining.pop()
+            self.lexer, self.scope, self.filepath, self.name, self.location = saved
+            self.extends, self.extending, self.blocks, self.block_depth = inheritance
+        self.scope.prelude.extend(
+            stmt for stmt in imported.prelude
+            if isinstance(stmt, (ast.FunctionDef, ast.AsyncFunctionDef)))
+        self.namespaces[namespace] = {
+            name: varname for name, varname in imported.names.items() if varname in self.macros}
+        return []
+
+    def joined(self, chunks):
+        if self.mode == 'bytes':
+            # output of includes is already encoded
+            return astutils.Call(
+                'join_chunks', ast.Name(chunks, ast.Load()), ast.Constant(self.encoding))
+        return ast.Call(
+            func=ast.Attribute(ast.Constant(''), 'join', ast.Load()),
+            args=[ast.Name(chunks, ast.Load())], keywords=[])
+
+    def fragment(self):
+        key = self.expr()
+        ttl = ast.Constant(None)
+        if self.lexer.next_is('id', 'ttl'):
+            self.lexer.next()
+            self.lexer.consume('assign')
+            ttl = self.expr()
+        self.lexer.consume('rdelim')
+        self.scope.depth += 1
+        body = self.nodelist(until=['end'])
+        self.scope.depth -= 1
+        self.lexer.consume('keyword', 'end')
+        self.lexer.consume('rdelim')
+
+        if self.param_fragments not in self.bound:
+            self.bound.append(self.param_fragments)
+        cache = ast.Name(self.param_fragments, ast.Load())
+        keyname, value, chunks = self._unique_name(), self._unique_name(), self._unique_name()
+
+        class Capture(ast.NodeTransformer):
+            # output of the block is collected instead of yielded
+            def visit_Expr(self, node):
+                node = self.generic_visit(node)
+                if isinstance(node.value, (ast.Yield, ast.YieldFrom)):
+                    method = 'append' if isinstance(node.value, ast.Yield) else 'extend'
+                    node.value = ast.Call(
+                        func=ast.Attribute(ast.Name(chunks, ast.Load()), method, ast.Load()),
+                        args=[node.value.value], keywords=[])
+                return node
+
+        body = [Capture().visit(stmt) for stmt in body]
+        joined = self.joined(chunks)
+        return [
+            ast.Assign([ast.Name(keyname, ast.Store())], key),
+            ast.Assign([ast.Name(value, ast.Store())], ast.Call(
+                func=ast.Attribute(cache, 'get', ast.Load()),
+                args=[ast.Name(keyname, ast.Load())], keywords=[])),
+            ast.If(
+                ast.Compare(ast.Name(value, ast.Load()), [ast.Is()], [ast.Constant(None)]),
+                [ast.Assign([ast.Name(chunks, ast.Store())], ast.List([], ast.Load()))] + body + [
+                    ast.Assign([ast.Name(value, ast.Store())], joined),
+                    ast.Expr(ast.Call(
+                        func=ast.Attribute(cache, 'set', ast.Load()),
+                        args=[ast.Name(keyname, ast.Load()), ast.Name(value, ast.Load()), ttl],
+                        keywords=[]))],
+                []),
+            ast.Expr(ast.Yield(ast.Name(value, ast.Load()))),
+        ]
 
     def assign(self):
         var = self.lexer.consume('id').value
         self.lexer.consume('assign')
-        node = ast.Assign(
-            [ast.Subscript(ast.Name('context', ast.Load()),
-             ast.Index(ast.Str(var)),
-             ast.Store())],
-            self.expr())
+        value = self.expr()
         self.lexer.consume('rdelim')
-        return node
+        return ast.Assign([ast.Name(self.bind(var), ast.Store())], value)
 
     def loop(self):
-        target = self.lexer.consume('id').value
+        token = self.lexer.consume('id')
+        target = token.value
         self.lexer.consume('colon')
         iter = self.expr()
         self.lexer.consume('rdelim')
-        body = self.nodelist(until=['end'])
-        self.lexer.consume('keyword', 'end')
+
+        self.push_scope()
+        varname = self.declare(target)
+        # a target named `loop` takes precedence over the loop variable
+        loopname = self.declare('loop') if target != 'loop' else None
+        body = self.pop_scope(self.nodelist(until=['else', 'end']))
+        orelse = None
+        if self.lexer.next().value == 'else':
+            self.lexer.consume('rdelim')
+            self.scope.depth += 1
+            orelse = self.nodelist(until=['end']) or [ast.Pass()]
+            self.scope.depth -= 1
+            self.lexer.consume('keyword', 'end')
         self.lexer.consume('rdelim')
 
-        varname = self._unique_name()
-        stmt_ctx_call = astutils.Call(
-            self.param_context,
-            ast.Dict(keys=[ast.Str(target)], values=[ast.Name(varname, ast.Load())]))
-        stmt_with = astutils.With(stmt_ctx_call, body)
-        return ast.For(ast.Name(varname, ast.Store()), iter, [stmt_with], [])
+        prelude = []
+        if loopname is not None and any(
+                isinstance(node, ast.Name) and node.id == loopname
+                for stmt in body for node in ast.walk(stmt)):
+            prelude.append(ast.Assign(
+                [ast.Name(loopname, ast.Store())], astutils.Call('LoopContext', iter)))
+            iter = ast.Name(loopname, ast.Load())
+        elif self.is_async:
+            iter = astutils.Call(self.func_aiter, iter)
+        if self.profile:
+            counter = self._unique_name()
+            increment = ast.AugAssign(ast.Name(counter, ast.Store()), ast.Add(), ast.Constant(1))
+            body = [increment] + body
+        loop = ast.AsyncFor if self.is_async else ast.For
+        node = loop(ast.Name(varname, ast.Store()), iter, body or [ast.Pass()], [])
+        if self.profile:
+            node = self.profile_loop(node, counter, token.pos)
+        else:
+            node = [node]
+        if orelse is not None:
+            # the loop variable keeps the context as a marker if nothing was iterated
+            marker = ast.Name(self.scope.context, ast.Load())
+            prelude.append(ast.Assign([ast.Name(varname, ast.Store())], marker))
+            node.append(ast.If(
+                ast.Compare(ast.Name(varname, ast.Load()), [ast.Is()], [marker]), orelse, []))
+        return prelude + node
+
+    def profile_loop(self, node, counter, pos):
+        started = self._unique_name()
+        name = '{}:{}'.format(self.name, self.lexer.position(pos)[0])
+        elapsed = ast.BinOp(
+            astutils.Call(self.func_clock), ast.Sub(), ast.Name(started, ast.Load()))
+        return [
+            ast.Assign([ast.Name(started, ast.Store())], astutils.Call(self.func_clock)),
+            ast.Assign([ast.Name(counter, ast.Store())], ast.Constant(0)),
+            node,
+            ast.Expr(astutils.Call(
+                self.func_probe, ast.Constant('loop'), ast.Constant(name), elapsed,
+                ast.Name(counter, ast.Load()))),
+        ]
 
     def cond(self):
         cond = self.expr()
         root = node = ast.If(test=cond, body=[], orelse=[])
         self.lexer.consume('rdelim')
+        self.scope.depth += 1
         while True:
-            node.body = self.nodelist(until=['elif', 'else', 'end'])
+            node.body = self.nodelist(until=['elif', 'else', 'end']) or [ast.Pass()]
             next = self.lexer.next()
             if next.value == 'elif':
                 orelse = ast.If(test=self.expr(), body=[], orelse=[])
@@ -393,13 +1236,14 @@ class Compiler:
                 node.orelse = []
                 self.lexer.consume('rdelim')
             break
+        self.scope.depth -= 1
         return root
 
     def atom(self):
         if self.lexer.next_is('str'):
-            return ast.Str(self.lexer.next().value)
+            return ast.Constant(self.lexer.next().value)
         elif self.lexer.lookup().type in {'int', 'float'}:
-            return ast.Num(self.lexer.next().value)
+            return ast.Constant(self.lexer.next().value)
         elif self.lexer.next_is('lround'):
             self.lexer.next()
             node = self.expr()
@@ -413,18 +1257,42 @@ class Compiler:
 
     def attr(self):
         if self.lexer.next_is('id'):
-            node = ast.Subscript(
-                ast.Name(self.param_context, ast.Load()),
-                ast.Index(ast.Str(self.lexer.next().value)),
-                ast.Load())
-            while self.lexer.lookup().type in {'dot', 'lsquare'}:
+            token = self.lexer.next()
+            if token.value in self.namespaces and self.lexer.next_is('dot'):
+                self.lexer.next()
+                member = self.lexer.consume('id')
+                macros = self.namespaces[token.value]
+                if member.value not in macros:
+                    raise TemplateSyntaxError(
+                        'no macro {} in {}'.format(member.value, token.value),
+                        source=self.lexer.source, pos=member.pos)
+                node = self.locate(ast.Name(macros[member.value], ast.Load()), token.pos)
+            else:
+                node = self.locate(self.awaited(self.lookup(token.value)), token.pos)
+            while self.lexer.lookup().type in {'dot', 'lsquare', 'lround'}:
                 x = self.lexer.next()
-                if x.type == 'dot':
+                if x.type == 'lround':
+                    args = []
+                    while not self.lexer.next_is('rround'):
+                        args.append(self.expr())
+                        if not self.lexer.next_is('comma'):
+                            break
+                        self.lexer.next()
+                    self.lexer.consume('rround')
+                    node = ast.Call(func=node, args=args, keywords=[])
+                elif x.type == 'dot':
                     token = self.lexer.consume('id')
-                    node = astutils.Call(self.param_getattr, node, ast.Str(token.value))
+                    site = 'attr_{}_{}'.format(len(self.bound), token.value)
+                    if site.isidentifier():
+                        self.bound.append(site)
+                        node = astutils.Call(site, node)
+                    else:
+                        node = astutils.Call(
+                            self.param_getattr, node, ast.Constant(token.value))
                 elif x.type == 'lsquare':
                     node = astutils.Call(self.param_getattr, node, self.attr())
                     self.lexer.consume('rsquare')
+                node = self.locate(self.awaited(node), x.pos)
             return node
         return self.atom()
 
@@ -442,16 +1310,42 @@ class Compiler:
         node = self.attr()
         while self.lexer.next_is('pipe'):
             self.lexer.next()
-            filter_name = self.lexer.consume('id').value
+            token = self.lexer.consume('id')
             params = self.params()
-            node = ast.Call(
-                func=ast.Subscript(
+            name = 'filter_' + token.value
+            if name.isidentifier():
+                if name not in self.bound:
+                    self.bound.append(name)
+                func = ast.Name(name, ast.Load())
+            else:
+                func = ast.Subscript(
                     ast.Name(self.param_filters, ast.Load()),
-                    ast.Index(ast.Str(filter_name)),
-                    ast.Load()),
-                args=[node] + params, keywords=[])
+                    ast.Index(ast.Constant(token.value)),
+                    ast.Load())
+            node = self.locate(self.awaited(ast.Call(
+                func=func, args=[node] + params, keywords=[])), token.pos)
         return node
 
+    def resolve_call(self, node):
+        """Returns the function a generated call refers to, if known at compile time."""
+        func = node.func
+        if isinstance(func, ast.Name):
+            if func.id == self.param_getattr:
+                return attr
+            if func.id == self.param_tostr:
+                return self.formatter
+            if func.id in self.bound:
+                kind, _, name = func.id.partition('_')
+                if kind == 'filter':
+                    return self.filters.get(name)
+                key = name.partition('_')[2]
+                return foldable(lambda obj: attr(obj, key))
+        elif isinstance(func, ast.Subscript) \
+                and isinstance(func.value, ast.Name) and func.value.id == self.param_filters:
+            key = func.slice.value if isinstance(func.slice, ast.Index) else func.slice
+            if isinstance(key, ast.Constant):
+                return self.filters.get(key.value)
+
     def comp(self):
         node = self.pipe()
         while self.lexer.next_is('comp'):
@@ -483,7 +1377,8 @@ class Compiler:
             if token.type == 'eof':
                 break
             elif token.type == 'raw':
-                children.append(ast.Expr(ast.Yield(ast.Str(token.value))))
+                children.append(self.locate(
+                    ast.Expr(ast.Yield(ast.Constant(token.value))), token.pos))
             elif token.type == 'ldelim':
                 if self.lexer.next_is('keyword'):
                     next = self.lexer.lookup()
@@ -494,10 +1389,12 @@ class Compiler:
                             'unknown keyword: {}'.format(next.value),
                             source=self.lexer.source, pos=token.pos)
                     token = self.lexer.next()
-                    children.append(self.keyword_handlers[token.value]())
+                    node = self.keyword_handlers[token.value]()
+                    for stmt in node if isinstance(node, list) else [node]:
+                        children.append(self.locate(stmt, token.pos))
                 else:
                     escaped = astutils.Call(self.param_tostr, self.expr())
-                    children.append(ast.Expr(ast.Yield(escaped)))
+                    children.append(self.locate(ast.Expr(ast.Yield(escaped)), token.pos))
                     self.lexer.consume('rdelim')
             else:
                 raise TemplateSyntaxError(
@@ -505,9 +1402,86 @@ class Compiler:
                     source=self.lexer.source, pos=token.pos)
         return children
 
+    def appendlist(self, nodes, write=None, extend=None):
+        # rewrites yields into appends to a list, one call per straight-line run
+        write = write or self.var_write
+        extend = extend or self.var_extend
+        children, run = [], []
+
+        def flush():
+            if len(run) == 1:
+                children.append(ast.Expr(astutils.Call(write, run[0])))
+            elif run:
+                children.append(ast.Expr(astutils.Call(
+                    extend, ast.Tuple(list(run), ast.Load()))))
+            del run[:]
+
+        for node in nodes:
+            if isinstance(node, ast.Expr) and isinstance(node.value, ast.Yield):
+                run.append(node.value.value)
+                continue
+            flush()
+            if isinstance(node, ast.Expr) and isinstance(node.value, ast.YieldFrom):
+                node = ast.Expr(astutils.Call(extend, node.value.value))
+            for field in ('body', 'orelse'):
+                if isinstance(getattr(node, field, None), list):
+                    setattr(node, field, self.appendlist(getattr(node, field), write, extend))
+            children.append(node)
+        flush()
+        return children
+
+    def render_body(self, nodes):
+        buf = ast.Name(self.var_buffer, ast.Load())
+        return [
+            ast.Assign([ast.Name(self.var_buffer, ast.Store())], ast.List([], ast.Load())),
+            ast.Assign(
+                [ast.Name(self.var_write, ast.Store())],
+                ast.Attribute(buf, 'append', ast.Load())),
+            ast.Assign(
+                [ast.Name(self.var_extend, ast.Store())],
+                ast.Attribute(buf, 'extend', ast.Load())),
+        ] + self.appendlist(nodes) + [
+            ast.Return(ast.Call(
+                func=ast.Attribute(ast.Constant(''), 'join', ast.Load()),
+                args=[buf], keywords=[])),
+        ]
+
+    def bytes_body(self, nodes):
+        encoding = self.encoding
+
+        class Encoder(ast.NodeTransformer):
+            # raw text is encoded once here, dynamic output when it is yielded
+            def visit_Yield(self, node):
+                value = node.value
+                if isinstance(value, ast.Constant) and isinstance(value.value, str):
+                    node.value = ast.copy_location(
+                        ast.Constant(value.value.encode(encoding)), value)
+                else:
+                    node.value = ast.copy_location(ast.Call(
+                        func=ast.Attribute(value, 'encode', ast.Load()),
+                        args=[ast.Constant(encoding)], keywords=[]), value)
+                return node
+
+        return [Encoder().visit(node) for node in nodes]
+
     def compile(self, raw=False):
-        tmpl = self.nodelist()
-        tmpl_wrapper = astutils.FunctionDef(
+        self.push_scope(self.param_context)
+        self.prepare()
+        tmpl = self.pop_scope(self.nodelist())
+        if self.extends is not None:
+            tmpl = self.inherit(tmpl)
+        tmpl = Optimizer(self).optimize(tmpl)
+        if self.mode == 'render':
+            tmpl = self.render_body(tmpl)
+        else:
+            if self.mode == 'bytes':
+                tmpl = self.bytes_body(tmpl)
+            if not any(isinstance(node, (ast.Yield, ast.YieldFrom))
+                       for stmt in tmpl for node in ast.walk(stmt)):
+                # keeps root a generator even if the template has no output
+                tmpl = tmpl + [ast.Return(None), ast.Expr(ast.Yield(None))]
+        function = astutils.AsyncFunctionDef if self.is_async else astutils.FunctionDef
+        tmpl_wrapper = function(
             name=self.funcname,
             args=[
                 self.param_context,
@@ -516,7 +1490,8 @@ class Compiler:
                 self.param_getattr,
                 self.param_loader,
             ],
-            body=tmpl)
+            body=tmpl,
+            kwonlyargs=self.bound)
 
         if sys.version_info[:3] >= (3, 8, 0):
             tmpl_module = ast.Module([tmpl_wrapper], type_ignores=[])
@@ -529,45 +1504,868 @@ class Compiler:
             return tmpl_module
 
         code = compile(tmpl_module, self.filename, mode='exec')
-        code_env = {}
-        exec(code, code_env)
-        return code_env[self.funcname]
+        return exec_code(code, self.funcname)
+
+
+class Optimizer(ast.NodeTransformer):
+    constant_types = (str, int, float, bool, type(None))
+
+    # statements that need at least one statement in their body
+    bodied = (
+        ast.For, ast.AsyncFor, ast.If, ast.While, ast.With, ast.AsyncWith, ast.Try,
+        ast.ExceptHandler, ast.FunctionDef, ast.AsyncFunctionDef)
+
+    comp_ops = {
+        ast.Eq: lambda a, b: a == b,
+        ast.NotEq: lambda a, b: a != b,
+        ast.LtE: lambda a, b: a <= b,
+        ast.GtE: lambda a, b: a >= b,
+        ast.Lt: lambda a, b: a < b,
+        ast.Gt: lambda a, b: a > b,
+    }
+
+    def __init__(self, compiler):
+        self.compiler = compiler
+
+    def optimize(self, nodes):
+        return self.merge([x for node in nodes for x in self.flatten(self.visit(node))])
+
+    def flatten(self, node):
+        if node is None:
+            return []
+        return node if isinstance(node, list) else [node]
+
+    def constant(self, value):
+        if type(value) in self.constant_types:
+            return ast.Constant(value)
+        if type(value) in (list, tuple) and all(type(x) in self.constant_types for x in value):
+            elts = [ast.Constant(x) for x in value]
+            return ast.List(elts, ast.Load()) if type(value) is list else ast.Tuple(elts, ast.Load())
+
+    def merge(self, nodes):
+        # joins adjacent raw fragments and drops empty ones
+        children = []
+        for node in nodes:
+            value = node.value.value \
+                if isinstance(node, ast.Expr) and isinstance(node.value, ast.Yield) else None
+            if isinstance(value, ast.Constant) and isinstance(value.value, str):
+                if not value.value:
+                    continue
+                prev = children[-1].value.value if children \
+                    and isinstance(children[-1], ast.Expr) \
+                    and isinstance(children[-1].value, ast.Yield) else None
+                if isinstance(prev, ast.Constant) and isinstance(prev.value, str):
+                    prev.value += value.value
+                    continue
+            children.append(node)
+        return children
+
+    def generic_visit(self, node):
+        node = super().generic_visit(node)
+        for field in ('body', 'orelse'):
+            if isinstance(getattr(node, field, None), list):
+                setattr(node, field, self.merge(getattr(node, field)))
+        if isinstance(node, self.bodied) and not node.body:
+            node.body = [ast.Pass()]
+        return node
+
+    def visit_Call(self, node):
+        node = self.generic_visit(node)
+        func = self.compiler.resolve_call(node)
+        if not (func is str or getattr(func, 'foldable', False)):
+            return node
+        if node.keywords or not all(isinstance(arg, ast.Constant) for arg in node.args):
+            return node
+        try:
+            value = func(*[arg.value for arg in node.args])
+        except Exception:
+            return node
+        folded = self.constant(value)
+        if folded is None:
+            return node
+        for child in ast.walk(folded):
+            ast.copy_location(child, node)
+        return folded
+
+    def visit_Await(self, node):
+        node = self.generic_visit(node)
+        call = node.value
+        if isinstance(call, ast.Call) and isinstance(call.func, ast.Name) \
+                and call.func.id == self.compiler.func_await \
+                and isinstance(call.args[0], ast.Constant):
+            return call.args[0]
+        return node
+
+    def visit_Compare(self, node):
+        node = self.generic_visit(node)
+        operands = [node.left] + node.comparators
+        if not all(isinstance(x, ast.Constant) for x in operands):
+            return node
+        try:
+            result = all(
+                self.comp_ops[type(op)](a.value, b.value)
+                for op, a, b in zip(node.ops, operands, operands[1:]))
+        except Exception:
+            return node
+        return ast.copy_location(ast.Constant(result), node)
+
+    def visit_BoolOp(self, node):
+        node = self.generic_visit(node)
+        if not all(isinstance(x, ast.Constant) for x in node.values):
+            return node
+        for value in node.values[:-1]:
+            if bool(value.value) != isinstance(node.op, ast.And):
+                return value
+        return node.values[-1]
+
+    def visit_If(self, node):
+        node = self.generic_visit(node)
+        if not isinstance(node.test, ast.Constant):
+            return node
+        branch = node.body if node.test.value else node.orelse
+        return [x for x in branch if not isinstance(x, ast.Pass)]
+
+
+def exec_code(code, funcname='root', **env):
+    code_env = dict(runtime, **env)
+    exec(code, code_env)
+    return code_env[funcname]
+
+
+def code_fingerprint(code):
+    """Identifies a function body, so that code folded with it is not reused once it changes."""
+    if code is None:
+        return None
+    consts = []
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            const = code_fingerprint(const)
+        elif isinstance(const, frozenset):
+            const = sorted(map(repr, const))
+        consts.append(const)
+    return code.co_code, consts, code.co_names
+
+
+class BytecodeCache:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def key(self, source, *options):
+        digest = hashlib.sha1()
+        for part in (__version__, sys.version, source) + options:
+            digest.update(repr(part).encode('utf-8'))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.cache')
+
+    def load(self, key):
+        """Returns (code, dependencies, includes) or None."""
+        try:
+            with open(self.path(key), 'rb') as f:
+                entry = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(entry, tuple) or len(entry) != 3 \
+                or not isinstance(entry[0], types.CodeType):
+            return None
+        return entry
+
+    def dump(self, key, code, dependencies=(), includes=()):
+        """`dependencies` are (filepath, fullpath, digest) of inlined templates,
+        `includes` the fullpaths of all included ones."""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key)
+        tmppath = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmppath, 'wb') as f:
+                marshal.dump((code, tuple(dependencies), tuple(includes)), f)
+            os.replace(tmppath, path)
+        except OSError:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
 
 
 class Template:
     def __init__(self, content, loader=None, filepath=None, **options):
         self.loader = loader
         self.content = content
-        self.formatter = htmlescape if options.get('autoescape', True) else str
+        self.options = {
+            k: v for k, v in options.items() if k not in ('funcs', 'dependencies', 'includes')}
+        self.autoescape = options.get('autoescape', True)
+        self.formatter = htmlescape if self.autoescape else str
         self.filepath = filepath
+        self.name = filepath or '<string>'
+        if loader is not None and filepath:
+            self.filename = os.path.normpath(os.path.join(loader.basedir, filepath))
+        else:
+            self.filename = self.name
         self.locals = options.get('locals', {})
-        self.func = Compiler(Lexer(self.content, options.get('cleanlines', True))).compile()
-        self.load = lambda path, params: self.loader.get(path, self).render(**params)
+        self.cleanlines = options.get('cleanlines', True)
+        self.minify = options.get('minify', False)
+        self.bytecode_cache = options.get('bytecode_cache')
+        self.buffer_size = options.get('buffer_size')
+        self.encoding = options.get('encoding', 'utf-8')
+        self.async_mode = options.get('async_mode', False)
+        self.profiler = options.get('profiler')
+        self.inline_includes = options.get('inline_includes', False) and loader is not None
+        self.dependencies = set(options.get('dependencies', ()))
+        self.includes = set(options.get('includes', ()))
+        self.codes = {}
+        self.filters = options.get('filters', filter)
+        self.fragment_cache = options.get('fragment_cache')
+        self.funcs = {mode: self.bind(func) for mode, func in options.get('funcs', {}).items()}
+        self.function('async' if self.async_mode else 'render')
+        self.load = lambda path, params: (self.loader.get(path, self).render(**params),)
+        self.load_stream = lambda path, params: self.loader.get(path, self).generate(**params)
+        self.load_async = lambda path, params: self.loader.get(path, self).generate_async(**params)
+        self.load_bytes = lambda path, params: self.loader.get(path, self).generate_bytes(**params)
+        if self.profiler is not None:
+            self.load = self.profiler.timed_include(self.load)
+            self.load_stream = self.profiler.timed_include(self.load_stream)
+            self.load_async = self.profiler.timed_include(self.load_async)
+            self.load_bytes = self.profiler.timed_include(self.load_bytes)
+
+    def function(self, mode):
+        try:
+            return self.funcs[mode]
+        except KeyError:
+            pass
+        if self.profiler is None:
+            code = self.codes[mode] = self.compile(mode)
+            func = self.funcs[mode] = self.bind(exec_code(code))
+            return func
+        started = time.perf_counter()
+        code = self.codes[mode] = self.compile(mode)
+        func = self.funcs[mode] = self.bind(exec_code(
+            code, probe=self.profiler.record, clock=time.perf_counter))
+        self.profiler.record('compile', self.name, time.perf_counter() - started)
+        return func
+
+    def bind(self, func):
+        """Returns a copy of a compiled function with its filters and attr call sites bound."""
+        code = func.__code__
+        names = code.co_varnames[code.co_argcount:code.co_argcount + code.co_kwonlyargcount]
+        if not names:
+            return func
+        defaults = {}
+        for name in names:
+            kind, _, rest = name.partition('_')
+            if name == 'fragment_cache':
+                if self.fragment_cache is None:
+                    self.fragment_cache = FragmentCache()
+                defaults[name] = self.fragment_cache
+            elif kind == 'filter':
+                defaults[name] = self.filters.get(rest) or missing_filter(rest)
+            else:
+                defaults[name] = attr_site(rest.partition('_')[2])
+        func = types.FunctionType(
+            code, func.__globals__, func.__name__, func.__defaults__, func.__closure__)
+        func.__kwdefaults__ = defaults
+        return func
+
+    def compile(self, mode='stream'):
+        filename = self.filename
+        profile = self.profiler is not None
+        cache = self.bytecode_cache
+        if cache is not None:
+            key = cache.key(
+                self.content, filename, self.cleanlines, self.autoescape, mode, profile,
+                self.encoding, self.inline_includes, self.minify, sorted(
+                    (name, func.__module__, func.__qualname__,
+                     code_fingerprint(getattr(func, '__code__', None)))
+                    for name, func in self.filters.items() if getattr(func, 'foldable', False)))
+            entry = cache.load(key)
+            if entry is not None:
+                code, dependencies, includes = entry
+                # inlined templates are part of the code and must not have changed
+                if all(self._digest(relpath, fullpath) == digest
+                       for relpath, fullpath, digest in dependencies):
+                    self.dependencies.update(fullpath for _, fullpath, _ in dependencies)
+                    self.includes.update(includes)
+                    return code
+
+        code = compile(self.module(mode), filename, mode='exec')
+        if cache is not None:
+            cache.dump(key, code, [
+                (relpath, fullpath, self._digest(relpath, fullpath))
+                for relpath, fullpath in sorted(self._inlined)], sorted(self.includes))
+        return code
+
+    def _digest(self, relpath, fullpath):
+        try:
+            source = self.loader.read(relpath, fullpath)
+        except (OSError, AttributeError):
+            return None
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    def module(self, mode='stream', profile=None):
+        if profile is None:
+            profile = self.profiler is not None
+        lexer = Lexer(self.content, self.cleanlines, self.minify)
+        compiler = Compiler(
+            lexer, self.filename, mode=mode, formatter=self.formatter, filters=self.filters,
+            profile=profile, name=self.name, encoding=self.encoding,
+            loader=self.loader, filepath=self.filepath, inline_includes=self.inline_includes,
+            cleanlines=self.cleanlines, minify=self.minify)
+        module = compiler.compile(raw=True)
+        self._inlined = compiler.dependencies
+        self.dependencies.update(fullpath for _, fullpath in compiler.dependencies)
+        self.includes.update(compiler.includes)
+        return module
+
+    def context(self, params):
+        return Context(params, self.locals or None)
+
+    def generate(self, **params):
+        func = self.function('stream')
+        chunks = func(self.context(params), self.formatter, self.filters, attr, self.load_stream)
+        if self.profiler is not None:
+            return self.profiler.timed(chunks, 'render', self.name)
+        return chunks
+
+    def generate_async(self, **params):
+        func = self.function('async')
+        chunks = func(self.context(params), self.formatter, self.filters, attr, self.load_async)
+        if self.profiler is not None:
+            return self.profiler.timed_async(chunks, 'render', self.name)
+        return chunks
+
+    def generate_bytes(self, **params):
+        func = self.function('bytes')
+        chunks = func(self.context(params), self.formatter, self.filters, attr, self.load_bytes)
+        if self.profiler is not None:
+            return self.profiler.timed(chunks, 'render', self.name)
+        return chunks
+
+    def stream(self, **params):
+        chunks = self.generate(**params)
+        if self.buffer_size:
+            return buffered(chunks, self.buffer_size)
+        return chunks
+
+    def stream_bytes(self, **params):
+        chunks = self.generate_bytes(**params)
+        if self.buffer_size:
+            return buffered(chunks, self.buffer_size, b'')
+        return chunks
+
+    def stream_async(self, **params):
+        chunks = self.generate_async(**params)
+        if self.buffer_size:
+            return buffered_async(chunks, self.buffer_size)
+        return chunks
 
     def render(self, **params):
-        if self.locals:
-            ctx = Context(self.locals)
-            ctx(params)
+        func = self.function('render')
+        if self.profiler is None:
+            return func(self.context(params), self.formatter, self.filters, attr, self.load)
+        started = time.perf_counter()
+        try:
+            return func(self.context(params), self.formatter, self.filters, attr, self.load)
+        finally:
+            self.profiler.record('render', self.name, time.perf_counter() - started)
+
+    def render_bytes(self, **params):
+        return b''.join(self.generate_bytes(**params))
+
+    async def render_async(self, **params):
+        return ''.join([chunk async for chunk in self.generate_async(**params)])
+
+    def render_many(self, contexts, workers=None, chunksize=64, ordered=True):
+        """Renders the template with each context dict in a pool of processes.
+
+        Every worker builds the template once from its source and loader, through the
+        bytecode cache if one is set. Contexts are read lazily, with a couple of chunks
+        per worker in flight, and results come in input order unless `ordered` is false.
+        """
+        workers = workers or os.cpu_count() or 1
+        options = {k: v for k, v in self.options.items() if k != 'profiler'}
+        pool = multiprocessing.Pool(
+            workers, _render_init, (self.loader, self.filepath, self.content, options))
+        try:
+            yield from _render_pool(pool, contexts, chunksize, 2 * workers, ordered)
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+_worker = {}
+
+
+def _render_init(loader, filepath, content, options):
+    _worker['template'] = Template(content, loader=loader, filepath=filepath, **options)
+
+
+def _render_chunk(contexts):
+    render = _worker['template'].render
+    return [render(**context) for context in contexts]
+
+
+def _render_pool(pool, contexts, chunksize, limit, ordered):
+    contexts = iter(contexts)
+    results, finished = {}, queue.Queue()
+    count = first = 0
+    exhausted = False
+    while True:
+        while not exhausted and len(results) < limit:
+            chunk = list(itertools.islice(contexts, chunksize))
+            if not chunk:
+                exhausted = True
+                break
+            notify = None if ordered else functools.partial(
+                lambda index, _: finished.put(index), count)
+            results[count] = pool.apply_async(
+                _render_chunk, (chunk,), callback=notify, error_callback=notify)
+            count += 1
+        if not results:
+            return
+        if ordered:
+            index, first = first, first + 1
         else:
-            ctx = Context(params)
-        return ''.join(self.func(ctx, self.formatter, filter, attr, self.load))
+            index = finished.get()
+        yield from results.pop(index).get()
+
+
+def buffered(chunks, size, empty=''):
+    buf, buflen = [], 0
+    for chunk in chunks:
+        buf.append(chunk)
+        buflen += len(chunk)
+        if buflen >= size:
+            yield empty.join(buf)
+            buf, buflen = [], 0
+    if buf:
+        yield empty.join(buf)
+
+
+async def buffered_async(chunks, size):
+    buf, buflen = [], 0
+    async for chunk in chunks:
+        buf.append(chunk)
+        buflen += len(chunk)
+        if buflen >= size:
+            yield ''.join(buf)
+            buf, buflen = [], 0
+    if buf:
+        yield ''.join(buf)
+
+
+class Profiler:
+    """Collects compile, render, include and loop timings of instrumented templates.
+
+    Events are aggregated in `stats` as {(event, name): {'count': n, 'time': seconds}}
+    and passed to `callback(event, name, elapsed, count)` as they happen. Timings of
+    streamed output include the time the consumer spends between chunks.
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def record(self, event, name, elapsed, count=1):
+        with self.lock:
+            stat = self.stats.setdefault((event, name), {'count': 0, 'time': 0.0})
+            stat['count'] += count
+            stat['time'] += elapsed
+        if self.callback is not None:
+            self.callback(event, name, elapsed, count)
+
+    def reset(self):
+        with self.lock:
+            self.stats.clear()
+
+    def timed(self, chunks, event, name):
+        started = time.perf_counter()
+        try:
+            yield from chunks
+        finally:
+            self.record(event, name, time.perf_counter() - started)
+
+    async def timed_async(self, chunks, event, name):
+        started = time.perf_counter()
+        try:
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            self.record(event, name, time.perf_counter() - started)
+
+    def timed_include(self, load):
+        def timed_load(path, params):
+            started = time.perf_counter()
+            chunks = load(path, params)
+            if inspect.isgenerator(chunks):
+                return self.timed(chunks, 'include', path)
+            if inspect.isasyncgen(chunks):
+                return self.timed_async(chunks, 'include', path)
+            self.record('include', path, time.perf_counter() - started)
+            return chunks
+        return timed_load
+
+
+class LRUCache:
+    def __init__(self, maxsize=None, on_evict=None):
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.data = collections.OrderedDict()
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.data.move_to_end(key)
+            except KeyError:
+                return default
+            return self.data[key]
+
+    def set(self, key, value):
+        evicted = []
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while self.maxsize is not None and len(self.data) > self.maxsize:
+                evicted.append(self.data.popitem(last=False))
+        if self.on_evict:
+            for key, value in evicted:
+                self.on_evict(key, value)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.data.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class FragmentCache:
+    """Keeps the output of #cache blocks in an in-process LRU cache.
+
+    Templates get their own cache unless one is passed as `fragment_cache`. Other
+    stores can be plugged in by overriding `load(key)` and `store(key, value, ttl)`;
+    `get` and `set` are what templates call and keep the hit and miss counts.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.data = LRUCache(maxsize)
+        self.hits = 0
+        self.misses = 0
+
+    def __reduce__(self):
+        return (self.__class__, (self.maxsize,))
+
+    def get(self, key):
+        value = self.load(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.store(key, value, ttl)
+
+    def load(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires is not None and expires <= time.monotonic():
+            self.data.pop(key)
+            return None
+        return value
+
+    def store(self, key, value, ttl):
+        expires = time.monotonic() + ttl if ttl is not None else None
+        self.data.set(key, (expires, value))
+
+    def clear(self):
+        self.data.clear()
+        self.hits = self.misses = 0
 
 
 class Loader:
-    def __init__(self, basedir, **params):
+    def __init__(self, basedir, cache_size=400, auto_reload=True, on_evict=None, **params):
         self.basedir = basedir
         self.params = params
-
-    def get(self, filepath, template=None):
+        self.auto_reload = auto_reload
+        self.cache = LRUCache(cache_size, on_evict) if cache_size != 0 else None
+        self.hits = 0
+        self.misses = 0
+        # include graph of the templates loaded so far, by fullpath
+        self.graph = {}
+        self.filepaths = {}
+        self.lock = threading.Lock()
+
+    def __reduce__(self):
+        # loaders are sent to worker processes with their settings, not their cache
+        options = dict(self.params, auto_reload=self.auto_reload)
+        options['cache_size'] = self.cache.maxsize if self.cache is not None else 0
+        options.pop('profiler', None)
+        return (_rebuild_loader, (self.__class__, self.basedir, options))
+
+    def resolve(self, filepath, parent=None):
+        """Returns (filepath, fullpath); `parent` is the filepath of the including template."""
         if filepath.startswith('./'):
-            filepath = os.path.join(os.path.dirname(template.filepath), filepath[2:])
+            filepath = os.path.join(os.path.dirname(parent), filepath[2:])
         fullpath = os.path.join(self.basedir, filepath)
         # TODO: check if fullpath is in basedir
+        return filepath, os.path.normpath(fullpath)
+
+    def get(self, filepath, template=None):
+        filepath, fullpath = self.resolve(filepath, template and template.filepath)
+        if self.cache is None:
+            return self.store(filepath, fullpath, None, self.load(filepath, fullpath))
+
+        cached = self.cache.get(fullpath)
+        if cached is not None:
+            mtimes, tmpl = cached
+            if not self.auto_reload or all(self.mtime(path) == mtime for path, mtime in mtimes):
+                self.hits += 1
+                return tmpl
+        self.misses += 1
+        mtime = self.mtime(fullpath)
+        return self.store(filepath, fullpath, mtime, self.load(filepath, fullpath))
+
+    def store(self, filepath, fullpath, mtime, tmpl):
+        with self.lock:
+            self.filepaths[fullpath] = filepath
+            self.graph[fullpath] = frozenset(tmpl.includes | tmpl.dependencies)
+        if self.cache is None:
+            return tmpl
+        # templates with inlined includes go stale together with their dependencies
+        mtimes = [(fullpath, mtime)] + [(path, self.mtime(path)) for path in tmpl.dependencies]
+        self.cache.set(fullpath, (mtimes, tmpl))
+        return tmpl
+
+    def dependents(self, filepath):
+        """Returns the filepaths of loaded templates that include `filepath`, directly or not."""
+        _, fullpath = self.resolve(filepath)
+        with self.lock:
+            graph = dict(self.graph)
+        found, todo = set(), [fullpath]
+        while todo:
+            path = todo.pop()
+            for parent, includes in graph.items():
+                if path in includes and parent not in found:
+                    found.add(parent)
+                    todo.append(parent)
+        found.discard(fullpath)
+        return sorted(self.filepaths[path] for path in found)
+
+    def invalidate(self, filepath):
+        """Drops `filepath` and its dependents from the cache, returns their filepaths."""
+        filepaths = [self.resolve(filepath)[0]] + self.dependents(filepath)
+        for path in filepaths:
+            fullpath = self.resolve(path)[1]
+            if self.cache is not None:
+                self.cache.pop(fullpath)
+            with self.lock:
+                self.graph.pop(fullpath, None)
+        return filepaths
+
+    def warmup(self, workers=None, executor='thread', filepaths=None, pattern=None):
+        """Compiles all templates (or `filepaths`) in parallel and caches them.
+
+        `pattern` restricts the templates as in `list_templates`. With executor='process' templates are compiled in worker processes, which
+        requires picklable loader params; the code is then loaded in this process,
+        without profiling instrumentation. A `bytecode_cache` is filled either way.
+        """
+        if filepaths is None:
+            filepaths = self.list_templates(pattern)
+        if executor == 'thread':
+            with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+                return list(pool.map(self.get, filepaths))
+        if executor != 'process':
+            raise ValueError('unknown executor: {}'.format(executor))
+        params = {k: v for k, v in self.params.items() if k != 'profiler'}
+        mode = 'async' if params.get('async_mode') else 'render'
+        tasks = [(self.basedir, params, filepath, mode) for filepath in filepaths]
+        templates = []
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            for filepath, content, code, includes, dependencies in pool.map(_warmup, tasks):
+                filepath, fullpath = self.resolve(filepath)
+                mtime = self.mtime(fullpath)
+                tmpl = Template(
+                    content, loader=self, filepath=filepath,
+                    funcs={mode: exec_code(marshal.loads(code))},
+                    includes=includes, dependencies=dependencies, **self.params)
+                templates.append(self.store(filepath, fullpath, mtime, tmpl))
+        return templates
+
+    def render_many(self, filepath, contexts, **options):
+        """Renders a template with each context in a pool of processes, see `Template.render_many`."""
+        return self.get(filepath).render_many(contexts, **options)
+
+    def mtime(self, fullpath):
+        return os.path.getmtime(fullpath)
+
+    def read(self, filepath, fullpath):
         with open(fullpath) as f:
-            x = f.read()
-            return Template(x, loader=self, filepath=filepath, **self.params)
+            return f.read()
+
+    def load(self, filepath, fullpath):
+        x = self.read(filepath, fullpath)
+        return Template(x, loader=self, filepath=filepath, **self.params)
+
+    def clear(self):
+        if self.cache is not None:
+            self.cache.clear()
+
+    def list_templates(self, pattern=None):
+        """Lists the files under basedir, skipping hidden ones.
+
+        `pattern` is a glob matched against the relative path with '/' separators,
+        e.g. '*.html', so that assets or a bytecode cache dir are left out.
+        """
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(self.basedir):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+            for filename in sorted(filenames):
+                if not filename.startswith('.'):
+                    fullpath = os.path.join(dirpath, filename)
+                    relpath = os.path.relpath(fullpath, self.basedir)
+                    if pattern is None or fnmatch.fnmatchcase(
+                            relpath.replace(os.sep, '/'), pattern):
+                        paths.append(relpath)
+        return paths
+
+
+def _rebuild_loader(cls, source, options):
+    return cls(source, **options)
+
+
+def _warmup(task):
+    basedir, params, filepath, mode = task
+    tmpl = Loader(basedir, cache_size=0, **params).get(filepath)
+    return (filepath, tmpl.content, marshal.dumps(tmpl.codes[mode]),
+            tmpl.includes, tmpl.dependencies)
+
+
+class ModuleLoader(Loader):
+    """Serves templates precompiled with `precompile` without lexing or compiling them."""
+
+    def __init__(self, module, **params):
+        if isinstance(module, str):
+            module = importlib.import_module(module)
+        self.module = module
+        params = dict(module.options, **params)
+        params.setdefault('auto_reload', False)
+        super().__init__('', **params)
+
+    def __reduce__(self):
+        rebuild, (cls, _, options) = super().__reduce__()
+        return rebuild, (cls, self.module.__name__, options)
+
+    def mtime(self, fullpath):
+        return 0
+
+    def read(self, filepath, fullpath):
+        if fullpath not in self.module.sources:
+            raise IOError('template not found: {}'.format(filepath))
+        return self.module.sources[fullpath]
+
+    def load(self, filepath, fullpath):
+        x = self.read(filepath, fullpath)
+        includes = getattr(self.module, 'includes', {}).get(fullpath, ())
+        return Template(
+            x, loader=self, filepath=filepath, funcs=self.module.templates[fullpath],
+            includes=includes, **self.params)
+
+    def list_templates(self, pattern=None):
+        return sorted(
+            filepath for filepath in self.module.templates
+            if pattern is None or fnmatch.fnmatchcase(filepath.replace(os.sep, '/'), pattern))
+
+
+def precompile(loader, output, pattern=None):
+    """Writes every template of the loader into a single importable module.
+
+    `pattern` restricts the templates as in `Loader.list_templates`.
+
+    Requires Python 3.9 or newer. The code is written without the loop probes of a
+    profiler, which can only be bound at runtime.
+    """
+    if not hasattr(ast, 'unparse'):
+        raise NotImplementedError('precompile requires Python 3.9 or newer')
+    options = {
+        'autoescape': loader.params.get('autoescape', True),
+        'cleanlines': loader.params.get('cleanlines', True),
+        'minify': loader.params.get('minify', False),
+        'async_mode': loader.params.get('async_mode', False),
+    }
+    modes = ['async'] if options['async_mode'] else ['render', 'stream', 'bytes']
+    lines = [
+        '# generated by misai {}, do not edit'.format(__version__),
+        'from misai import {}'.format(', '.join(sorted(runtime))),
+        '',
+        'options = {!r}'.format(options),
+        '',
+    ]
+    templates, sources, includes = [], [], []
+    for i, filepath in enumerate(loader.list_templates(pattern)):
+        tmpl = loader.get(filepath)
+        funcs = []
+        for mode in modes:
+            funcname = 't{}_{}'.format(i, mode)
+            module = tmpl.module(mode, profile=False)
+            module.body[0].name = funcname
+            lines += ['', ast.unparse(module), '']
+            funcs.append('{!r}: {}'.format(mode, funcname))
+        key = os.path.normpath(filepath)
+        templates.append('    {!r}: {{{}}},'.format(key, ', '.join(funcs)))
+        sources.append('    {!r}: {!r},'.format(key, tmpl.content))
+        includes.append('    {!r}: {!r},'.format(key, sorted(
+            os.path.relpath(path, loader.basedir) for path in tmpl.includes)))
+    lines += ['', 'templates = {'] + templates + ['}', '', 'sources = {'] + sources + ['}', '']
+    lines += ['includes = {'] + includes + ['}', '']
+    with open(output, 'w') as f:
+        f.write('\n'.join(lines))
 
 
 def render(source, context=None):
     context = context or {}
     return Template(source).render(**context)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m misai')
+    commands = parser.add_subparsers(dest='command')
+    cmd_compile = commands.add_parser(
+        'compile', help='precompile a template directory into a python module')
+    cmd_compile.add_argument('basedir')
+    cmd_compile.add_argument('-o', '--output', required=True)
+    cmd_compile.add_argument('--no-autoescape', dest='autoescape', action='store_false')
+    cmd_compile.add_argument('--no-cleanlines', dest='cleanlines', action='store_false')
+    cmd_compile.add_argument('--async', dest='async_mode', action='store_true')
+    cmd_compile.add_argument('--inline-includes', action='store_true')
+    cmd_compile.add_argument('--minify', action='store_true')
+    cmd_compile.add_argument(
+        '--pattern', help="only compile templates matching this glob, e.g. '*.html'")
+    args = parser.parse_args(argv)
+
+    if args.command == 'compile':
+        loader = Loader(
+            args.basedir, autoescape=args.autoescape, cleanlines=args.cleanlines,
+            async_mode=args.async_mode, inline_includes=args.inline_includes,
+            minify=args.minify)
+        try:
+            precompile(loader, args.output, args.pattern)
+        except NotImplementedError as e:
+            parser.error(str(e))
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,5 @@
 # coding: utf-8
+import re
 from setuptools import setup
 from setuptools.command.test import test as TestCommand
 
@@ -11,9 +12,13 @@ class PyTestCommand(TestCommand):
         sys.exit(pytest.main([]))
 
 
+with open('misai.py') as f:
+    version = re.search(r"^__version__ = '(.+)'$", f.read(), re.M).group(1)
+
+
 setup(
     name='misai',
-    version='0.1.1',
+    version=version,
     description='simple template engine',
     long_description=open('readme.rst').read(),
     url='https://github.com/nkanaev/misai',
@@ -24,15 +29,20 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2.7',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
         'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
+        'Programming Language :: Python :: 3.13',
     ],
     author='Nazar Kanaev',
     author_email='nkanaev@live.com',
     py_modules=['misai'],
+    python_requires='>=3.7',
     package_data={'': ['readme.rst']},
     include_package_data=True,
     test_suite='test',
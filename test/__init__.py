@@ -0,0 +1,7 @@
+import os
+
+
+def write(path, content, mtime=1000):
+    with open(path, 'w') as f:
+        f.write(content)
+    os.utime(path, (mtime, mtime))
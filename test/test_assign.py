@@ -9,3 +9,9 @@ def test_assign_simple():
 def test_assign_filter():
     t = Template('{{ #set x = "foo" | capitalize }}{{ x }}')
     assert t.render() == 'Foo'
+
+
+def test_assign_conditional():
+    t = Template('{{ #if c }}{{ #set x = "set" }}{{ #end }}{{ x }}')
+    assert t.render(c=0, x='outer') == 'outer'
+    assert t.render(c=1, x='outer') == 'set'
@@ -0,0 +1,77 @@
+import asyncio
+import os
+
+from misai import Loader, Template, filter
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+tmpl_dir = os.path.join(here, 'templates')
+
+
+@filter
+async def slow_upper(value):
+    await asyncio.sleep(0)
+    return value.upper()
+
+
+async def fetch(value):
+    await asyncio.sleep(0)
+    return value
+
+
+async def rows(n):
+    for i in range(n):
+        await asyncio.sleep(0)
+        yield {'id': i}
+
+
+def test_render_async():
+    t = Template('{{ #for row : rows }}{{ row.id }}{{ #end }}', async_mode=True)
+    assert asyncio.run(t.render_async(rows=rows(3))) == '012'
+
+
+def test_awaitables():
+    t = Template(
+        '{{ #if user.active }}{{ user.name | slow_upper }}{{ #end }}'
+        '{{ #for x : items }}{{ x }}{{ #end }}',
+        async_mode=True)
+    result = asyncio.run(t.render_async(
+        user=fetch({'active': True, 'name': 'bob'}), items=fetch([1, 2])))
+    assert result == 'BOB12'
+
+
+def test_stream_async():
+    t = Template('{{ #for row : rows }}{{ row.id }},{{ #end }}', async_mode=True, buffer_size=4)
+
+    async def collect():
+        return [chunk async for chunk in t.stream_async(rows=rows(4))]
+
+    assert asyncio.run(collect()) == ['0,1,', '2,3,']
+
+
+def test_include_async():
+    loader = Loader(tmpl_dir, async_mode=True)
+    result = asyncio.run(loader.get('base.txt').render_async(endword=fetch('!!!')))
+    assert result == 'onetwothree!!!'
+
+
+def test_async_loop_variable():
+    async def items():
+        for item in 'ab':
+            yield item
+
+    t = Template(
+        '{{ #for a : items }}{{ a }}{{ #if loop.last }}.{{ #end }}{{ #else }}-{{ #end }}',
+        async_mode=True)
+    assert asyncio.run(t.render_async(items=items())) == 'ab.'
+    assert asyncio.run(t.render_async(items=[])) == '-'
+
+
+def test_async_empty_loop_body():
+    for source in [
+            '{{ #for b : items }}{{ #if 0 }}x{{ #end }}{{ #end }}.',
+            '{{ #for b : items }}\n{{ #end }}.',
+            '{{ #for b : items }}{{ #if 0 }}{{ #end }}'
+            '{{ #else }}{{ #if 0 }}{{ #end }}{{ #end }}.']:
+        t = Template(source, async_mode=True)
+        assert asyncio.run(t.render_async(items=[1])) == Template(source).render(items=[1])
@@ -0,0 +1,52 @@
+import os
+
+import misai
+from misai import BytecodeCache, Filters, Template, foldable
+
+
+def test_bytecode_cache(tmp_path, monkeypatch):
+    cache = BytecodeCache(str(tmp_path))
+    assert Template('{{ x }}!', bytecode_cache=cache).render(x=1) == '1!'
+    assert len(os.listdir(str(tmp_path))) == 1
+
+    def fail(*args, **kwargs):
+        raise AssertionError('template was recompiled')
+
+    monkeypatch.setattr(misai.Compiler, 'compile', fail)
+    assert Template('{{ x }}!', bytecode_cache=cache).render(x=2) == '2!'
+
+
+def test_bytecode_cache_key():
+    cache = BytecodeCache('.')
+    assert cache.key('a') == cache.key('a')
+    assert cache.key('a') != cache.key('b')
+    assert cache.key('a', True) != cache.key('a', False)
+
+
+def test_bytecode_cache_corrupt(tmp_path):
+    cache = BytecodeCache(str(tmp_path))
+    Template('{{ x }}', bytecode_cache=cache)
+    filename, = os.listdir(str(tmp_path))
+    with open(str(tmp_path / filename), 'wb') as f:
+        f.write(b'garbage')
+    assert Template('{{ x }}', bytecode_cache=cache).render(x=1) == '1'
+
+
+def test_bytecode_cache_foldable_filter(tmp_path):
+    cache = BytecodeCache(str(tmp_path))
+
+    @foldable
+    def shout(s):
+        return s.upper()
+
+    filters = Filters(shout=shout)
+    assert Template('{{ "a" | shout }}', bytecode_cache=cache, filters=filters).render() == 'A'
+
+    # same name, changed implementation
+    @foldable
+    def shout(s):
+        return s + '!'
+
+    filters = Filters(shout=shout)
+    assert Template('{{ "a" | shout }}', bytecode_cache=cache, filters=filters).render() == 'a!'
+    assert len(os.listdir(str(tmp_path))) == 2
@@ -0,0 +1,72 @@
+import asyncio
+
+from misai import Loader, Template, lazy
+
+
+def counter(value):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return value
+    return compute, calls
+
+
+def test_lazy():
+    compute, calls = counter('v')
+    t = Template('{{ #if show }}{{ x }}{{ x }}{{ #end }}.')
+    assert t.render(show=False, x=lazy(compute)) == '.'
+    assert calls == []
+    assert t.render(show=True, x=lazy(compute)) == 'vv.'
+    assert calls == [1]
+
+
+def test_lazy_locals():
+    compute, calls = counter('d')
+    t = Template('{{ x }}{{ x }}', locals={'x': lazy(compute)})
+    assert t.render() == 'dd'
+    assert t.render() == 'dd'
+    assert calls == [1, 1]
+
+
+def test_lazy_include(tmp_path):
+    with open(str(tmp_path / 'part.txt'), 'w') as f:
+        f.write('{{ #if show }}{{ x }}{{ #end }}')
+    with open(str(tmp_path / 'page.txt'), 'w') as f:
+        f.write('{{ #add "part.txt" x=x show=show }}|{{ #if again }}{{ x }}{{ #end }}')
+    page = Loader(str(tmp_path)).get('page.txt')
+    compute, calls = counter('v')
+    assert page.render(x=lazy(compute), show=False, again=False) == '|'
+    assert calls == []
+    assert page.render(x=lazy(compute), show=True, again=True) == 'v|v'
+    assert calls == [1]
+    assert ''.join(page.stream(x=lazy(compute), show=False, again=True)) == '|v'
+    assert calls == [1, 1]
+
+
+def test_lazy_async():
+    async def fetch():
+        return 'a'
+
+    t = Template('{{ x }}{{ x }}', async_mode=True)
+    assert asyncio.run(t.render_async(x=lazy(fetch))) == 'aa'
+
+
+def test_lazy_include_async(tmp_path):
+    with open(str(tmp_path / 'part.txt'), 'w') as f:
+        f.write('{{ #if show }}{{ x }}{{ #end }}')
+    with open(str(tmp_path / 'page.txt'), 'w') as f:
+        f.write('{{ #add "part.txt" x=x show=show }}|{{ #if again }}{{ x }}{{ #end }}')
+    page = Loader(str(tmp_path), async_mode=True).get('page.txt')
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        return 'a'
+
+    assert asyncio.run(page.render_async(x=lazy(fetch), show=False, again=False)) == '|'
+    assert calls == []
+    assert asyncio.run(page.render_async(x=lazy(fetch), show=True, again=True)) == 'a|a'
+    assert calls == [1]
+    assert asyncio.run(page.render_async(x=lazy(fetch), show=False, again=True)) == '|a'
+    assert calls == [1, 1]
@@ -1,4 +1,6 @@
-from misai import render, filter
+import traceback
+
+from misai import Loader, render, filter
 
 
 @filter
@@ -42,3 +44,34 @@ def test_precedence():
 def test_groups():
     assert render('{{ 0 and  1 or 2  and 3 }}') == '3'
     assert render('{{ 0 and (1 or 2) and 3 }}') == '0'
+
+
+def test_traceback_position(tmp_path):
+    (tmp_path / 'page.txt').write_text('line one\n{{ #for x : items }}\n  {{ x | add: 1 }}\n{{ #end }}\n')
+    template = Loader(str(tmp_path)).get('page.txt')
+    try:
+        template.render(items=[1, 'a'])
+    except TypeError as e:
+        frame = [f for f in traceback.extract_tb(e.__traceback__) if f.name == 'root'][0]
+    assert frame.filename == str(tmp_path / 'page.txt')
+    assert frame.lineno == 3
+
+
+class Slotted:
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+
+class Mapping(dict):
+    name = 'attr'
+
+
+def test_attr_site():
+    items = [
+        {'name': 'a'}, Slotted('b'), Slotted('c'), {'x': 1}, Mapping(name='d'), Mapping(),
+        Slotted(None), {'name': 'e'}]
+    del items[6].name
+    result = render('{{ #for x: items }}{{ x.name }},{{ #end }}', {'items': items})
+    assert result == 'a,b,c,None,d,attr,None,e,'
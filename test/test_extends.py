@@ -0,0 +1,110 @@
+import os
+import sys
+import traceback
+
+import pytest
+
+from misai import Loader, Template, TemplateSyntaxError
+
+from . import write
+
+
+@pytest.fixture
+def basedir(tmp_path):
+    write(
+        str(tmp_path / 'base.html'),
+        '<{{ #block head }}{{ title }}{{ #end }}|'
+        '{{ #for i: items }}{{ #block item }}{{ i }}{{ #end }}{{ #end }}|'
+        '{{ #block body }}base{{ #end }}>')
+    write(
+        str(tmp_path / 'mid.html'),
+        '{{ #extends "base.html" }}ignored'
+        '{{ #block body }}mid:{{ #block inner }}default{{ #end }}{{ #end }}')
+    write(
+        str(tmp_path / 'child.html'),
+        '{{ #extends "./mid.html" }}'
+        '{{ #block inner }}{{ #if x }}{{ #set y = "set" }}{{ #end }}{{ y }}{{ #end }}'
+        '{{ #block item }}({{ item }}){{ #end }}')
+    return str(tmp_path)
+
+
+def test_extends(basedir):
+    loader = Loader(basedir)
+    assert loader.get('base.html').render(title='t', items=[1, 2]) == '<t|12|base>'
+    assert loader.get('mid.html').render(title='t', items=[1]) == '<t|1|mid:default>'
+    child = loader.get('child.html')
+    assert child.render(title='t', items=[1, 2], item='x', x=1, y='ctx') == '<t|(x)(x)|mid:set>'
+    assert child.render(title='t', items=[], x=0, y='ctx') == '<t||mid:ctx>'
+    assert ''.join(child.stream(title='t', items=[], x=0, y='ctx')) == '<t||mid:ctx>'
+
+
+def test_extends_single_function(basedir, monkeypatch):
+    loader = Loader(basedir)
+    child = loader.get('child.html')
+    monkeypatch.setattr(Loader, 'get', None)
+    assert child.render(title='t', items=[], x=0, y='') == '<t||mid:>'
+
+
+def test_extends_reload(basedir):
+    loader = Loader(basedir)
+    assert loader.get('child.html').render(title='t', items=[], x=0, y='') == '<t||mid:>'
+    write(os.path.join(basedir, 'base.html'), '[{{ #block body }}{{ #end }}]', 2000)
+    assert loader.get('child.html').render(x=0, y='') == '[mid:]'
+    assert loader.dependents('base.html') == ['child.html']
+
+
+def test_extends_errors(tmp_path):
+    write(str(tmp_path / 'a.html'), '{{ #extends "b.html" }}')
+    write(str(tmp_path / 'b.html'), '{{ #extends "a.html" }}')
+    write(str(tmp_path / 'c.html'), '{{ #if x }}{{ #extends "b.html" }}{{ #end }}')
+    loader = Loader(str(tmp_path))
+    with pytest.raises(TemplateSyntaxError):
+        loader.get('a.html')
+    with pytest.raises(TemplateSyntaxError):
+        loader.get('c.html')
+    with pytest.raises(TemplateSyntaxError):
+        Template('{{ #extends "a.html" }}')
+
+
+def test_extends_traceback(tmp_path):
+    write(str(tmp_path / 'base.html'), 'x\n{{ #block a }}{{ #end }}{{ missing }}')
+    write(str(tmp_path / 'page.html'), '\n\n{{ #extends "base.html" }}')
+    tmpl = Loader(str(tmp_path)).get('page.html')
+    try:
+        tmpl.render()
+    except IndexError:
+        frame = traceback.extract_tb(sys.exc_info()[2])[-2]
+    assert frame.filename == str(tmp_path / 'page.html')
+    assert frame.lineno == 3
+
+
+def test_extends_included(tmp_path):
+    write(str(tmp_path / 'base.html'), '<h>{{ #block title }}{{ #end }}</h>')
+    write(
+        str(tmp_path / 'child.html'),
+        '{{ #extends "base.html" }}{{ #block title }}Child {{ name }}{{ #end }}')
+    write(str(tmp_path / 'part.html'), '({{ #block title }}part{{ #end }})')
+    write(str(tmp_path / 'page.html'), 'P[{{ #add "child.html" name="x" }}]')
+    write(
+        str(tmp_path / 'layout.html'),
+        '{{ #extends "base.html" }}{{ #block title }}{{ #add "part.html" }}{{ #end }}')
+    for inline in (False, True):
+        loader = Loader(str(tmp_path), inline_includes=inline)
+        assert loader.get('page.html').render() == 'P[<h>Child x</h>]'
+        assert loader.get('layout.html').render() == '<h>(part)</h>'
+
+
+def test_block_before_extends(tmp_path):
+    write(str(tmp_path / 'base.html'), '<h>{{ #block title }}Base{{ #end }}</h>')
+    write(
+        str(tmp_path / 'bb.html'),
+        '{{ #block title }}early{{ #end }}\n{{ #extends "base.html" }}')
+    write(
+        str(tmp_path / 'mid.html'),
+        '{{ #block title }}mid {{ #block inner }}{{ #end }}{{ #end }}{{ #extends "base.html" }}')
+    write(
+        str(tmp_path / 'child.html'),
+        '{{ #block inner }}child{{ #end }}{{ #extends "mid.html" }}')
+    loader = Loader(str(tmp_path))
+    assert loader.get('bb.html').render() == '<h>early</h>'
+    assert loader.get('child.html').render() == '<h>mid child</h>'
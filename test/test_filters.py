@@ -1,6 +1,62 @@
-from misai import htmlescape, render, Template
+import timeit
+
+from misai import htmlescape, noescapestr, render, Template
 
 
 def test_escape():
     assert Template('<script>{{ foo }}', autoescape=False).render(foo='<script>') == '<script><script>'
     assert Template('<script>{{ foo }}').render(foo='<script>') == '<script>&lt;script&gt;'
+
+
+def legacy_htmlescape(input):
+    if isinstance(input, noescapestr):
+        return input
+    return str(input)\
+        .replace('&', '&amp;')\
+        .replace('<', '&lt;')\
+        .replace('>', '&gt;')\
+        .replace('"', '&#34;')\
+        .replace("'", '&#39;')
+
+
+samples = [
+    'plain text', '<a href="x">Tom & Jerry\'s</a>', '&amp;', '', 'x' * 5000,
+    'x' * 5000 + '<', 12345, 1.5, True, None, ['<'], noescapestr('<b>'),
+]
+
+
+def test_htmlescape():
+    for value in samples:
+        assert htmlescape(value) == legacy_htmlescape(value), value
+    assert type(htmlescape('x')) is str
+    assert type(htmlescape(noescapestr('<'))) is noescapestr
+
+
+def test_htmlescape_benchmark():
+    plain = [value for value in samples if legacy_htmlescape(value) == str(value)]
+    results = {}
+    for name, func in [('htmlescape', htmlescape), ('legacy', legacy_htmlescape)]:
+        results[name] = min(timeit.repeat(
+            lambda: [func(value) for value in plain], number=2000, repeat=5))
+    print('escape 2000 x {} values: {}'.format(len(plain), ', '.join(
+        '{} {:.3f}s'.format(name, t) for name, t in sorted(results.items()))))
+    assert results['htmlescape'] <= results['legacy']
+
+
+def test_template_filters():
+    filters = {'shout': lambda s: s.upper() + '!'}
+    tmpl = Template('{{ x|shout }}', filters=filters)
+    assert tmpl.render(x='hi') == 'HI!'
+    filters['shout'] = lambda s: s
+    assert tmpl.render(x='hi') == 'HI!'
+
+
+def test_missing_filter():
+    tmpl = Template('{{ #if x }}{{ x|nosuchfilter }}{{ #end }}')
+    assert tmpl.render(x='') == ''
+    try:
+        tmpl.render(x='a')
+    except KeyError:
+        pass
+    else:
+        assert False, 'expected KeyError'
@@ -0,0 +1,78 @@
+import asyncio
+import time
+
+from misai import FragmentCache, Loader, Template, filter
+
+
+calls = []
+
+
+@filter
+def expensive(value):
+    calls.append(value)
+    return value
+
+
+def test_fragment_cache():
+    del calls[:]
+    t = Template('<{{ #cache "nav" }}{{ #for i: items }}{{ i|expensive }}{{ #end }}{{ #end }}>')
+    assert t.render(items=[1, 2]) == '<12>'
+    assert t.render(items=[3]) == '<12>'
+    assert ''.join(t.stream(items=[3])) == '<12>'
+    assert t.render_bytes(items=[3]) == b'<12>'
+    assert calls == [1, 2]
+    assert (t.fragment_cache.hits, t.fragment_cache.misses) == (3, 1)
+
+
+def test_fragment_key():
+    cache = FragmentCache()
+    t = Template('{{ #cache "user" ttl=60 }}{{ name }}{{ #end }}', fragment_cache=cache)
+    t2 = Template('{{ #cache key }}{{ name }}{{ #end }}', fragment_cache=cache)
+    assert t.render(name='a') == 'a'
+    assert t2.render(key='user', name='b') == 'a'
+    assert t2.render(key='other', name='b') == 'b'
+    assert len(cache.data) == 2
+
+
+def test_fragment_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    t = Template('{{ #cache "k" ttl=10 }}{{ x }}{{ #end }}')
+    assert t.render(x=1) == '1'
+    now[0] += 5
+    assert t.render(x=2) == '1'
+    now[0] += 5
+    assert t.render(x=3) == '3'
+
+
+def test_fragment_backend():
+    class DictCache(FragmentCache):
+        def __init__(self):
+            super().__init__()
+            self.store_calls = []
+
+        def store(self, key, value, ttl):
+            self.store_calls.append((key, value, ttl))
+            super().store(key, value, ttl)
+
+    cache = DictCache()
+    t = Template('{{ #cache "k" ttl=5 }}x{{ #end }}', fragment_cache=cache)
+    assert t.render() + t.render() == 'xx'
+    assert cache.store_calls == [('k', 'x', 5)]
+
+
+def test_fragment_include(tmp_path):
+    with open(str(tmp_path / 'nav.txt'), 'w') as f:
+        f.write('[{{ x }}]')
+    with open(str(tmp_path / 'page.txt'), 'w') as f:
+        f.write('{{ #cache "nav" }}{{ #add "nav.txt" x=x }}{{ #end }}')
+    loader = Loader(str(tmp_path), fragment_cache=FragmentCache())
+    page = loader.get('page.txt')
+    assert page.render_bytes(x='é') == '[é]'.encode('utf-8')
+    assert page.render(x=2) == '[é]'
+
+
+def test_fragment_async():
+    t = Template('{{ #cache "k" }}{{ #for i: items }}{{ i }}{{ #end }}{{ #end }}', async_mode=True)
+    assert asyncio.run(t.render_async(items=[1])) == '1'
+    assert asyncio.run(t.render_async(items=[2])) == '1'
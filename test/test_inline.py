@@ -0,0 +1,70 @@
+import asyncio
+import os
+
+import pytest
+
+from misai import BytecodeCache, Loader
+
+from . import write
+
+
+@pytest.fixture
+def basedir(tmp_path):
+    os.mkdir(str(tmp_path / 'sub'))
+    write(str(tmp_path / 'page.html'), '<{{ #add "sub/item.html" x=z }}>')
+    write(str(tmp_path / 'sub/item.html'), '{{ x }}{{ #add "./leaf.html" }}')
+    write(str(tmp_path / 'sub/leaf.html'), '[{{ x }}{{ y }}]')
+    return str(tmp_path)
+
+
+def test_inline(basedir):
+    loader = Loader(basedir, inline_includes=True, locals={'x': 'L', 'y': 'Y'})
+    tmpl = loader.get('page.html')
+    assert tmpl.render(z=2, y='no') == '<2[LY]>'
+    assert ''.join(tmpl.stream(z=2)) == '<2[LY]>'
+    assert tmpl.render_bytes(z=2) == b'<2[LY]>'
+    assert loader.misses == 1
+    assert tmpl.dependencies == {
+        os.path.join(basedir, 'sub', 'item.html'), os.path.join(basedir, 'sub', 'leaf.html')}
+
+
+def test_inline_matches_runtime(basedir):
+    params = dict(locals={'x': 'L', 'y': 'Y'})
+    inlined = Loader(basedir, inline_includes=True, **params).get('page.html')
+    runtime = Loader(basedir, **params).get('page.html')
+    assert inlined.render(z=5) == runtime.render(z=5)
+
+
+def test_inline_async(basedir):
+    loader = Loader(basedir, inline_includes=True, async_mode=True, locals={'x': 'L', 'y': 'Y'})
+
+    async def one():
+        return 2
+
+    assert asyncio.run(loader.get('page.html').render_async(z=one())) == '<2[LY]>'
+
+
+def test_inline_recursive(tmp_path):
+    write(
+        str(tmp_path / 'tree.html'),
+        '({{ node.name }}{{ #for child: node.children }}{{ #add "tree.html" node=child }}{{ #end }})')
+    loader = Loader(str(tmp_path), inline_includes=True)
+    tree = {'name': 'a', 'children': [
+        {'name': 'b', 'children': []},
+        {'name': 'c', 'children': [{'name': 'd', 'children': []}]}]}
+    assert loader.get('tree.html').render(node=tree) == '(a(b)(c(d)))'
+
+
+def test_inline_reload(basedir):
+    loader = Loader(basedir, inline_includes=True, locals={'x': 'L', 'y': 'Y'})
+    assert loader.get('page.html').render(z=2) == '<2[LY]>'
+    write(os.path.join(basedir, 'sub', 'leaf.html'), '({{ y }})', 2000)
+    assert loader.get('page.html').render(z=2) == '<2(Y)>'
+
+
+def test_inline_bytecode_cache(basedir, tmp_path):
+    cache = BytecodeCache(str(tmp_path / 'cache'))
+    params = dict(inline_includes=True, bytecode_cache=cache, locals={'x': 'L', 'y': 'Y'})
+    assert Loader(basedir, **params).get('page.html').render(z=2) == '<2[LY]>'
+    write(os.path.join(basedir, 'sub', 'leaf.html'), '({{ y }})', 2000)
+    assert Loader(basedir, **params).get('page.html').render(z=2) == '<2(Y)>'
@@ -1,4 +1,8 @@
-from misai import Lexer, Token
+import random
+import re
+import timeit
+
+from misai import Lexer, Token, TemplateSyntaxError
 
 
 def test_delimiters():
@@ -78,3 +82,186 @@ def test_keywords():
         Token('rdelim', '}}', 17),
     ]
     assert tokens == lexer.tokens
+
+
+def test_comments():
+    lexer = Lexer('a{{# note #}}b')
+    assert [(t.type, t.value) for t in lexer.tokens] == [('raw', 'a'), ('raw', 'b')]
+
+
+# reference implementation of the trial-loop tokenizer the lexer used to have
+def legacy_tokenize(source):
+    c = re.compile
+    ldelim = '{{'
+    rdelim = '}}'
+    esc_ldelim = re.escape(ldelim)
+    esc_rdelim = re.escape(rdelim)
+    rules = {
+        'root': [
+            (c(r'%s#.+?#%s' % (esc_ldelim, esc_rdelim), re.S), 'comment'),
+            (c(r'(.*?)' + esc_ldelim, re.S), 'ldelim'),
+            (c(r'(.+)', re.S), 'raw'),
+        ],
+        'block': [
+            (c(esc_rdelim), 'rdelim'),
+            (c(r'\s+'), 'ws'),
+
+            # keyword
+            (c(r'#(\w+)'), 'keyword'),
+
+            (c(r':'), 'colon'),
+            (c(r'\.'), 'dot'),
+            (c(r','), 'comma'),
+            (c(r'\|'), 'pipe'),
+            (c(r'\('), 'lround'),
+            (c(r'\)'), 'rround'),
+            (c(r'\['), 'lsquare'),
+            (c(r'\]'), 'rsquare'),
+            (c(r'==|!=|<=|>=|<|>'), 'comp'),
+            (c(r'='), 'assign'),
+            (c(r'\b(and|or)\b'), 'logic'),
+
+            # literals
+            (c(r'\d+\.\d+\b'), 'float'),
+            (c(r'\d+\b'), 'int'),
+            (c(r'"(([^"\\]|\\.)*)"'), 'str'),
+            (c(r"'(([^'\\]|\\.)*)'"), 'str'),
+            (c(r'\b(\w+)\b'), 'id'),
+        ]
+    }
+    inside_delim = False
+    pos = 0
+    while pos < len(source):
+        for regex, name in rules['block' if inside_delim else 'root']:
+            m = regex.match(source, pos)
+            if not m:
+                continue
+
+            if pos == m.end() and name != 'ldelim':
+                # should not never happen
+                msg = '{} yielded empty string'.format(regex)
+                raise TemplateSyntaxError(msg)
+
+            pos_prev, pos = pos, m.end()
+            name = name or m.group()
+            match = m.group(1) if m.groups() else m.group()
+
+            if inside_delim:
+                if name == 'ws':
+                    break
+
+                value = match
+                if name == 'rdelim':
+                    inside_delim = False
+                elif name == 'int':
+                    value = int(match)
+                elif name == 'float':
+                    value = float(match)
+                elif name == 'str':
+                    value = match\
+                        .replace(r'\"', '"')\
+                        .replace(r"\'", "'")
+
+                yield Token(name, value, pos_prev)
+
+                break
+            else:
+                if name == 'comment':
+                    break
+                elif name == 'ldelim':
+                    if len(match) > 0:
+                        yield Token('raw', match, pos)
+                    yield Token('ldelim', ldelim, pos - len(ldelim))
+                    inside_delim = True
+                else:
+                    yield Token(name, match, pos)
+                break
+        else:
+            msg = 'unexpected char {}'.format(repr(source[pos]))
+            raise TemplateSyntaxError(msg, pos=pos, source=source)
+
+
+def large_template(rows=2000):
+    row = (
+        '<tr class="{{ cls }}">\n'
+        '  {{ #if row.visible and row.count >= 10 }}'
+        '<td>{{ row.name | capitalize }}</td><td>{{ row["id"] }}</td>'
+        '{{ #elif 1.5 != 2 or x < y }}<td>{{ \'it\\\'s\' }}</td>'
+        '{{ #else }}<td>{{ "a,b" | split: "," }}</td>{{ #end }}{{# comment #}}\n'
+        '</tr>\n')
+    return '<table>\n' + row * rows + '</table>'
+
+
+def test_large_template():
+    # the old tokenizer reported the end of raw text as its position
+    def strip_raw_pos(tokens):
+        return [t._replace(pos=None) if t.type == 'raw' else t for t in tokens]
+
+    source = large_template(200)
+    tokens = Lexer(source, cleanlines=False).tokens
+    assert strip_raw_pos(tokens) == strip_raw_pos(legacy_tokenize(source))
+    assert [t.pos for t in tokens if t.type == 'raw'][:2] == [0, source.index('">')]
+
+
+def test_benchmark():
+    source = large_template()
+    results = {}
+    for name, tokenize in [
+            ('combined', lambda: Lexer(source, cleanlines=False).tokens),
+            ('legacy', lambda: list(legacy_tokenize(source)))]:
+        count = len(tokenize())
+        results[name] = count / min(timeit.repeat(tokenize, number=1, repeat=3))
+    print('tokens/sec: ' + ', '.join(
+        '{} {:.0f}'.format(name, rate) for name, rate in sorted(results.items())))
+    assert results['combined'] >= results['legacy']
+
+
+# reference implementation of the eager whitespace cleaning the lexer used to do
+def legacy_clean(tokens):
+    il, ir = None, None
+    for i in range(len(tokens)):
+        if tokens[i].type == 'ldelim':
+            il = i
+        elif tokens[i].type == 'rdelim':
+            ir = i
+            if not il or tokens[il + 1].type != 'keyword':
+                il, ir = None, None
+                continue
+            m_l = (il == 0) \
+                or (tokens[il - 1].type == 'raw'
+                    and re.search('(^|\n|\r\n)[ \t]*$', tokens[il - 1].value))
+            m_r = (ir == len(tokens) - 1) \
+                or (tokens[ir + 1].type == 'raw'
+                    and re.search('^[ \t]*(\n|\r\n)', tokens[ir + 1].value))
+            if m_l and m_r:
+                if il != 0:
+                    old = tokens[il - 1]
+                    tokens[il - 1] = Token('raw', re.sub('[ \t]*$', '', old.value), old.pos)
+                if ir != len(tokens) - 1:
+                    old = tokens[ir + 1]
+                    value = re.sub('^[ \t]*(\n|\r\n)', '', old.value)
+                    tokens[ir + 1] = Token('raw', value, old.pos + len(old.value) - len(value))
+    return tokens
+
+
+def test_clean():
+    pieces = [
+        'a', ' ', '\t', '\n', '\r\n', 'x \n', '{{ #if x }}', '{{ #end }}', '{{ y }}',
+        '{{# c #}}', '  {{ #else }}  \n']
+    random.seed(1)
+    sources = [large_template(5), 'a\n  {{ #if x }}  \nb', '\n{{ #if x }}\n{{ #end }}\n']
+    for _ in range(3000):
+        sources.append(''.join(random.choice(pieces) for _ in range(random.randint(1, 8))))
+    for source in sources:
+        expected = legacy_clean(Lexer(source, cleanlines=False).tokens)
+        assert Lexer(source).tokens == expected, source
+
+
+def test_lazy():
+    lexer = Lexer('a{{ x }}b{{ 1 2 ')
+    assert lexer.next() == Token('raw', 'a', 0)
+    assert lexer.lookup() == Token('ldelim', '{{', 1)
+    assert [lexer.next().type for _ in range(4)] == ['ldelim', 'id', 'rdelim', 'raw']
+    assert lexer.next() == Token('ldelim', '{{', 9)
+    assert [lexer.next().value for _ in range(3)] == [1, 2, None]
+    assert lexer.lookup().type == 'eof'
@@ -0,0 +1,109 @@
+import os
+
+from misai import BytecodeCache, Loader
+
+from . import write
+
+
+def test_cache_hit(tmp_path):
+    write(str(tmp_path / 'a.txt'), 'a', 1000)
+    loader = Loader(str(tmp_path))
+    assert loader.get('a.txt') is loader.get('a.txt')
+    assert (loader.hits, loader.misses) == (1, 1)
+
+
+def test_cache_reload(tmp_path):
+    path = str(tmp_path / 'a.txt')
+    write(path, 'old', 1000)
+    loader = Loader(str(tmp_path))
+    assert loader.get('a.txt').render() == 'old'
+    write(path, 'new', 2000)
+    assert loader.get('a.txt').render() == 'new'
+    assert loader.misses == 2
+
+
+def test_cache_no_reload(tmp_path):
+    path = str(tmp_path / 'a.txt')
+    write(path, 'old', 1000)
+    loader = Loader(str(tmp_path), auto_reload=False)
+    assert loader.get('a.txt').render() == 'old'
+    write(path, 'new', 2000)
+    assert loader.get('a.txt').render() == 'old'
+
+
+def test_cache_eviction(tmp_path):
+    for name in 'abc':
+        write(str(tmp_path / name), name, 1000)
+    evicted = []
+    loader = Loader(
+        str(tmp_path), cache_size=2,
+        on_evict=lambda key, value: evicted.append(os.path.basename(key)))
+    loader.get('a')
+    loader.get('b')
+    loader.get('a')
+    loader.get('c')
+    assert evicted == ['b']
+    assert len(loader.cache) == 2
+
+
+def test_cache_disabled(tmp_path):
+    write(str(tmp_path / 'a.txt'), 'a', 1000)
+    loader = Loader(str(tmp_path), cache_size=0)
+    assert loader.get('a.txt') is not loader.get('a.txt')
+
+
+def include_tree(tmp_path):
+    os.mkdir(str(tmp_path / 'parts'))
+    write(str(tmp_path / 'page.html'), '<{{ #add "parts/row.html" }}>', 1000)
+    write(str(tmp_path / 'other.html'), '{{ #add "parts/cell.html" }}', 1000)
+    write(str(tmp_path / 'parts/row.html'), '[{{ #add "./cell.html" }}]', 1000)
+    write(str(tmp_path / 'parts/cell.html'), 'cell', 1000)
+    write(str(tmp_path / 'alone.html'), 'alone', 1000)
+
+
+def test_dependents(tmp_path):
+    include_tree(tmp_path)
+    loader = Loader(str(tmp_path))
+    loader.warmup(workers=2)
+    assert loader.misses == 5
+    assert loader.dependents('parts/cell.html') == [
+        'other.html', 'page.html', os.path.join('parts', 'row.html')]
+    assert loader.dependents('parts/row.html') == ['page.html']
+    assert loader.dependents('alone.html') == []
+
+
+def test_invalidate(tmp_path):
+    include_tree(tmp_path)
+    loader = Loader(str(tmp_path), auto_reload=False)
+    loader.warmup()
+    assert loader.get('page.html').render() == '<[cell]>'
+    assert loader.invalidate('parts/row.html') == ['parts/row.html', 'page.html']
+    assert len(loader.cache) == 3
+    write(str(tmp_path / 'parts/row.html'), '({{ #add "./cell.html" }})', 2000)
+    assert loader.get('page.html').render() == '<(cell)>'
+
+
+def test_warmup_process(tmp_path):
+    include_tree(tmp_path)
+    loader = Loader(str(tmp_path))
+    templates = loader.warmup(workers=2, executor='process')
+    assert [t.filepath for t in templates] == loader.list_templates()
+    assert loader.get('page.html').render() == '<[cell]>'
+    assert (loader.hits, loader.misses) == (3, 0)
+    assert loader.dependents('parts/row.html') == ['page.html']
+
+
+def test_warmup_pattern(tmp_path):
+    include_tree(tmp_path)
+    with open(str(tmp_path / 'logo.png'), 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n\xff')
+    loader = Loader(str(tmp_path), bytecode_cache=BytecodeCache(str(tmp_path / 'cache')))
+    assert len(loader.warmup(pattern='*.html')) == 5
+    assert loader.list_templates('*.html') == [
+        'alone.html', 'other.html', 'page.html',
+        os.path.join('parts', 'cell.html'), os.path.join('parts', 'row.html')]
+    assert loader.list_templates('parts/*') == [
+        os.path.join('parts', 'cell.html'), os.path.join('parts', 'row.html')]
+    loader = Loader(str(tmp_path), bytecode_cache=BytecodeCache(str(tmp_path / 'cache')))
+    templates = loader.warmup(executor='process', pattern='*.html')
+    assert [t.filepath for t in templates] == loader.list_templates('*.html')
@@ -6,6 +6,11 @@ def reverse(items):
     return reversed(items)
 
 
+@filter
+def length(items):
+    return len(items)
+
+
 def test_simple():
     t = Template('{{ #for a : b }}{{ a }}{{ #end }}')
     assert t.render(b=['foo', 'bar']) == 'foobar'
@@ -22,3 +27,57 @@ def test_scopes():
         '{{ #for foo : items }}{{ foo }}{{ #end }}'
         '{{ foo }}')
     assert t.render(items=['bar']) == 'barbaz'
+
+
+def test_nested_scopes():
+    t = Template(
+        '{{ #for a : rows }}{{ #for a : a }}{{ a }}{{ #end }}{{ a | length }}{{ #end }}')
+    assert t.render(rows=[[1, 2], [3]]) == '12231'
+
+
+def test_conditional_set():
+    t = Template(
+        '{{ #for i : items }}'
+        '{{ #if i }}{{ #set x = i }}{{ #end }}{{ x }}'
+        '{{ #end }}{{ x }}')
+    assert t.render(items=[0, 1, 0], x='-') == '-1--'
+
+
+def test_empty_body():
+    t = Template('{{ #for a : b }}{{ #end }}{{ #if 1 }}{{ #end }}')
+    assert t.render(b=[1]) == ''
+    assert list(t.generate(b=[1])) == []
+
+
+def test_loop_variable():
+    t = Template(
+        '{{ #for a : items }}{{ loop.index }}{{ a }}{{ loop.length }}'
+        '{{ #if loop.first }}F{{ #end }}{{ #if loop.last }}L{{ #end }}'
+        '{{ #if loop.odd }}o{{ #else }}e{{ #end }},{{ #end }}')
+    assert t.render(items='abc') == '1a3Fo,2b3e,3c3Lo,'
+    assert t.render(items=iter('ab')) == '1aNoneFo,2bNoneLe,'
+    assert t.render(items=[]) == ''
+
+
+def test_nested_loop_variable():
+    t = Template(
+        '{{ #for row : rows }}{{ #for a : row }}{{ loop.index }}{{ #end }}'
+        '{{ loop.index }};{{ #end }}')
+    assert t.render(rows=[[1, 2], [3]]) == '121;12;'
+
+
+def test_loop_else():
+    t = Template('{{ #for a : items }}{{ a }}{{ #else }}empty{{ #end }}!')
+    assert t.render(items=[None, 0]) == 'None0!'
+    assert t.render(items=[]) == 'empty!'
+    assert t.render(items=(x for x in [])) == 'empty!'
+    t = Template('{{ #for a : items }}{{ loop.index }}{{ #else }}{{ #end }}.')
+    assert t.render(items='xy') == '12.'
+    assert t.render(items='') == '.'
+
+
+def test_loop_target_named_loop():
+    t = Template('{{ #for loop : items }}{{ loop }}{{ #end }}')
+    assert t.render(items=['a', 'b']) == 'ab'
+    t = Template('{{ #for loop : rows }}{{ #for a : loop }}{{ loop.index }}{{ #end }}{{ #end }}')
+    assert t.render(rows=[[1, 2]]) == '12'
@@ -0,0 +1,124 @@
+import asyncio
+import os
+
+import pytest
+
+from misai import Loader, Template, TemplateSyntaxError
+
+from . import write
+
+
+def test_macro():
+    t = Template(
+        '{{ #for x: items }}{{ cell(x, loop.index) }}{{ #end }}'
+        '{{ #macro cell(value, n) }}<td>{{ n }}{{ value }}</td>{{ #end }}')
+    assert t.render(items=['<', 'b']) == '<td>1&lt;</td><td>2b</td>'
+    assert ''.join(t.stream(items=['a'])) == '<td>1a</td>'
+    assert t.render_bytes(items=['é']) == '<td>1é</td>'.encode('utf-8')
+
+
+def test_macro_scope():
+    t = Template(
+        '{{ #set greeting = "hi" }}'
+        '{{ #macro greet(name) }}{{ #set name = name|capitalize }}{{ greeting }} {{ name }}{{ #end }}'
+        '{{ greet("bob") }} {{ name }}')
+    assert t.render(name='ctx') == 'hi Bob ctx'
+
+
+def test_macro_recursive():
+    t = Template(
+        '{{ #macro tree(node) }}({{ node.name }}'
+        '{{ #for child: node.children }}{{ tree(child) }}{{ #end }}){{ #end }}'
+        '{{ tree(root) }}')
+    root = {'name': 'a', 'children': [{'name': 'b', 'children': []}]}
+    assert t.render(root=root) == '(a(b))'
+
+
+def test_context_call():
+    t = Template('{{ fmt("x", 2) }}{{ obj.upper() }}')
+    assert t.render(fmt=lambda a, b: a * b, obj='y') == 'xxY'
+
+
+def test_macro_async():
+    async def value():
+        return 'v'
+
+    t = Template('{{ #macro m(x) }}[{{ x }}{{ y }}]{{ #end }}{{ m(1) }}', async_mode=True)
+    assert asyncio.run(t.render_async(y=value())) == '[1v]'
+
+
+@pytest.fixture
+def basedir(tmp_path):
+    write(
+        str(tmp_path / 'forms.html'),
+        '{{ #macro field(name, value) }}<input name="{{ name }}" value="{{ value }}">'
+        '{{ label(name) }}{{ #end }}'
+        '{{ #macro label(text) }}<label>{{ text }}</label>{{ #end }}not rendered')
+    write(
+        str(tmp_path / 'page.html'),
+        '{{ #import "forms.html" as forms }}{{ forms.field("q", query) }}')
+    return str(tmp_path)
+
+
+def test_import(basedir):
+    loader = Loader(basedir)
+    page = loader.get('page.html')
+    assert page.render(query='<x>') == '<input name="q" value="&lt;x&gt;"><label>q</label>'
+    assert loader.get('page.html').dependencies == {os.path.join(basedir, 'forms.html')}
+
+
+def test_import_errors(basedir):
+    write(os.path.join(basedir, 'bad.html'), '{{ #import "forms.html" as f }}{{ f.missing() }}')
+    loader = Loader(basedir)
+    with pytest.raises(TemplateSyntaxError):
+        loader.get('bad.html')
+    with pytest.raises(TemplateSyntaxError):
+        Template('{{ #import "forms.html" as forms }}')
+
+
+def test_macro_extends(basedir):
+    write(os.path.join(basedir, 'base.html'), '<{{ #block body }}{{ #end }}>')
+    write(
+        os.path.join(basedir, 'child.html'),
+        '{{ #extends "base.html" }}{{ #import "forms.html" as forms }}'
+        '{{ #macro bold(x) }}<b>{{ x }}</b>{{ #end }}'
+        '{{ #block body }}{{ bold(forms.label("l")) }}{{ #end }}')
+    assert Loader(basedir).get('child.html').render() == '<<b><label>l</label></b>>'
+
+
+def test_import_isolated(basedir):
+    write(os.path.join(basedir, 'base.html'), '<base>{{ #block body }}B{{ #end }}</base>')
+    write(
+        os.path.join(basedir, 'lib.html'),
+        '{{ #macro m() }}M{{ #end }}{{ #block body }}FROMLIB{{ #end }}')
+    write(
+        os.path.join(basedir, 'child.html'),
+        '{{ #extends "base.html" }}{{ #import "lib.html" as l }}'
+        '{{ #block body }}child{{ l.m() }}{{ #end }}')
+    write(
+        os.path.join(basedir, 'layout.html'),
+        '{{ #extends "base.html" }}{{ #macro m() }}{{ #end }}')
+    write(
+        os.path.join(basedir, 'page.html'),
+        'PAGE {{ #import "layout.html" as l }}{{ l.m() }} END')
+    loader = Loader(basedir)
+    assert loader.get('child.html').render() == '<base>childM</base>'
+    with pytest.raises(TemplateSyntaxError) as e:
+        loader.get('page.html')
+    assert 'layout.html' in str(e.value)
+
+
+def test_macro_declarations():
+    assert Template('{{# {{ #macro foo() }} #}}{{ foo }}').render(foo='bar') == 'bar'
+    assert Template('{{ "{{ #macro q() }}" }}{{ q }}').render(q='ctx') == '{{ #macro q() }}ctx'
+    t = Template('{{ #for a : b }}{{ #macro m() }}x{{ #end }}{{ m() }}{{ #end }}{{ m }}')
+    assert t.render(b=[1, 2], m='ctx') == 'xxctx'
+    t = Template('{{ #if c }}{{ m() }}{{ #macro m() }}x{{ #end }}{{ #end }}')
+    assert t.render(c=1) == 'x'
+
+
+def test_macro_forward_call():
+    t = Template('{{ m() }}{{ #set x = 1 }}{{ m() }}{{ #macro m() }}{{ x }}{{ #end }}')
+    assert t.render(x='c') == 'c1'
+    t = Template('{{ #for a : items }}{{ #macro m() }}{{ a }}{{ #end }}{{ m() }}{{ #end }}')
+    assert t.render(items=[1, 2]) == '12'
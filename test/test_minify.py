@@ -0,0 +1,55 @@
+from misai import BytecodeCache, Loader, Template, minify_html
+
+
+def test_minify():
+    t = Template(
+        '<ul>\n  {{ #for a : items }}\n    <li>  {{ a }}  </li>\n  {{ #end }}\n</ul>\n',
+        minify=True)
+    # whitespace is collapsed within each raw text, never dropped across tags
+    assert t.render(items=['x', 'y']) == '<ul>  <li> x </li>  <li> y </li> </ul> '
+    assert Template('a \n b', minify=False).render() == 'a \n b'
+
+
+def test_preserved():
+    source = (
+        '<div>\n  <pre class="{{ cls }}">\n  a\n   b\n</pre>\n  <TEXTAREA>{{ x }}\n  </TEXTAREA>\n'
+        '<script>\n  var a;\n</script>  <style> p  {} </style>\n</div>')
+    t = Template(source, minify=True, autoescape=False)
+    assert t.render(cls='c  d', x=' \n ') == (
+        '<div> <pre class="c  d">\n  a\n   b\n</pre> <TEXTAREA> \n \n  </TEXTAREA> '
+        '<script>\n  var a;\n</script> <style> p  {} </style> </div>')
+
+
+def test_minify_html():
+    assert minify_html('a  <pre>  x', None) == ('a <pre>  x', 'pre')
+    assert minify_html('  </script> </pre>  y', 'pre') == ('  </script> </pre> y', None)
+    assert minify_html('<prefix>  </pre>  ') == ('<prefix> </pre> ', None)
+    assert minify_html('<a\n title="a   b"  alt=\'  \'>') == ('<a title="a   b" alt=\'  \'>', None)
+    assert minify_html('<p title="a  ') == ('<p title="a  ', '"')
+    assert minify_html('  b"  >  c', '"') == ('  b" > c', None)
+    assert minify_html('a < b  c') == ('a < b c', None)
+
+
+def test_comments():
+    assert minify_html('<!--  <pre>  -->  x') == ('<!--  <pre>  --> x', None)
+    t = Template('<!-- a  {{ x }}  b -->  <p title="{{ x }}  y">  </p>', minify=True)
+    assert t.render(x=1) == '<!-- a  1  b --> <p title="1  y"> </p>'
+
+
+def test_minify_bytecode_cache(tmp_path):
+    cache = BytecodeCache(str(tmp_path))
+    source = '<p>\n  x\n</p>'
+    assert Template(source, bytecode_cache=cache).render() == source
+    assert Template(source, bytecode_cache=cache, minify=True).render() == '<p> x </p>'
+
+
+def test_minify_include(tmp_path):
+    with open(str(tmp_path / 'part.html'), 'w') as f:
+        f.write('<b>\n  {{ x }}\n</b>')
+    with open(str(tmp_path / 'page.html'), 'w') as f:
+        f.write('<pre>  {{ #add "part.html" x=x }}  </pre>\n  ')
+    loader = Loader(str(tmp_path), minify=True, inline_includes=True)
+    assert loader.get('page.html').render(x=1) == '<pre>  <b>\n  1\n</b>  </pre> '
+    # templates included at runtime are minified on their own
+    loader = Loader(str(tmp_path), minify=True)
+    assert loader.get('page.html').render(x=1) == '<pre>  <b> 1 </b>  </pre> '
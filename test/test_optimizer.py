@@ -0,0 +1,42 @@
+from misai import Template, filter
+
+
+calls = []
+
+
+@filter
+def counted(value):
+    calls.append(value)
+    return value
+
+
+def test_raw_merge():
+    t = Template('a{{# comment #}}b{{ "c" }}{{ #if 1 }}\nd\n{{ #end }}e')
+    assert list(t.generate()) == ['abc\nd\ne']
+
+
+def test_fold_filters():
+    t = Template('{{ "a,b" | split: "," | attr: 1 | capitalize }}{{ x }}')
+    assert list(t.generate(x=1)) == ['B', '1']
+
+
+def test_fold_escape():
+    assert list(Template('{{ "<" }}').generate()) == ['&lt;']
+    assert list(Template('{{ "<" }}', autoescape=False).generate()) == ['<']
+    assert Template('{{ "<b>" | noescape }}').render() == '<b>'
+
+
+def test_fold_conditions():
+    t = Template(
+        '{{ #if 1 == 2 or 0 }}a{{ #elif "x" != "x" }}b'
+        '{{ #elif 1 < 2 and 3 }}c{{ #else }}d{{ #end }}')
+    assert list(t.generate()) == ['c']
+
+
+def test_no_fold_impure():
+    del calls[:]
+    t = Template('{{ "x" | counted }}')
+    assert calls == []
+    assert t.render() == 'x'
+    assert t.render() == 'x'
+    assert calls == ['x', 'x']
@@ -0,0 +1,63 @@
+import ast
+import importlib.util
+import os
+
+import pytest
+
+import misai
+from misai import Loader, ModuleLoader, Profiler, main, precompile
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+tmpl_dir = os.path.join(here, 'templates')
+
+
+def load_module(path):
+    spec = importlib.util.spec_from_file_location('compiled_templates', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.mark.skipif(not hasattr(ast, 'unparse'), reason='requires ast.unparse')
+def test_precompile(tmp_path, monkeypatch):
+    output = str(tmp_path / 'compiled_templates.py')
+    assert main(['compile', tmpl_dir, '-o', output]) == 0
+    module = load_module(output)
+
+    def fail(*args, **kwargs):
+        raise AssertionError('template was compiled at runtime')
+
+    monkeypatch.setattr(misai.Compiler, 'compile', fail)
+    loader = ModuleLoader(module)
+    assert loader.get('base.txt').render(endword='!!!') == 'onetwothree!!!'
+    assert ''.join(loader.get('test/foo.txt').stream()) == 'foobar'
+    assert loader.dependents('base_add.txt') == ['base.txt']
+    assert loader.list_templates() == sorted(
+        os.path.normpath(p) for p in ['bar.txt', 'base.txt', 'base_add.txt', 'test/foo.txt'])
+
+
+@pytest.mark.skipif(not hasattr(ast, 'unparse'), reason='requires ast.unparse')
+def test_precompile_profiler(tmp_path):
+    output = str(tmp_path / 'compiled_templates.py')
+    precompile(Loader(tmpl_dir, profiler=Profiler()), output)
+    profiler = Profiler()
+    loader = ModuleLoader(load_module(output), profiler=profiler)
+    assert loader.get('base.txt').render(endword='!!!') == 'onetwothree!!!'
+    assert ('render', 'base.txt') in profiler.stats
+
+
+def test_precompile_requires_unparse(tmp_path, monkeypatch, capsys):
+    monkeypatch.delattr(ast, 'unparse', raising=False)
+    with pytest.raises(SystemExit):
+        main(['compile', tmpl_dir, '-o', str(tmp_path / 'out.py')])
+    assert 'Python 3.9' in capsys.readouterr().err
+
+
+@pytest.mark.skipif(not hasattr(ast, 'unparse'), reason='requires ast.unparse')
+def test_precompile_pattern(tmp_path):
+    output = str(tmp_path / 'compiled_templates.py')
+    assert main(['compile', tmpl_dir, '-o', output, '--pattern', 'test/*']) == 0
+    loader = ModuleLoader(load_module(output))
+    assert loader.list_templates() == [os.path.normpath('test/foo.txt')]
+    assert loader.list_templates('*.html') == []
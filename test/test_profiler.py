@@ -0,0 +1,38 @@
+import ast
+import os
+
+from misai import Compiler, Lexer, Loader, Profiler, Template
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+tmpl_dir = os.path.join(here, 'templates')
+
+
+def test_template_stats():
+    profiler = Profiler()
+    t = Template('-\n{{ #for x : items }}{{ x }}{{ #end }}', profiler=profiler)
+    assert t.render(items=[1, 2, 3]) == '-\n123'
+    assert ''.join(t.stream(items=[1])) == '-\n1'
+
+    stats = profiler.stats
+    assert stats[('compile', '<string>')]['count'] == 2
+    assert stats[('render', '<string>')]['count'] == 2
+    assert stats[('loop', '<string>:2')]['count'] == 4
+
+
+def test_loader_stats():
+    events = []
+    profiler = Profiler(callback=lambda *event: events.append(event[:2]))
+    loader = Loader(tmpl_dir, profiler=profiler)
+    assert loader.get('base.txt').render(endword='!') == 'onetwothree!'
+    assert ('include', './base_add.txt') in events
+    assert ('render', 'base_add.txt') in events
+    assert ('loop', 'base_add.txt:1') in events
+    assert profiler.stats[('loop', 'base_add.txt:1')]['count'] == 3
+
+
+def test_no_instrumentation():
+    source = '{{ #for x : items }}{{ x }}{{ #end }}'
+    plain = Compiler(Lexer(source)).compile(raw=True)
+    names = {node.id for node in ast.walk(plain) if isinstance(node, ast.Name)}
+    assert 'probe' not in names and 'clock' not in names
@@ -0,0 +1,38 @@
+import os
+
+from misai import BytecodeCache, Loader, Template
+
+
+def test_render_many():
+    tmpl = Template('{{ #for i: items }}{{ i }}{{ #end }}-{{ name }}')
+    contexts = ({'items': [n, n], 'name': '<{}>'.format(n)} for n in range(100))
+    expected = ['{}{}-&lt;{}&gt;'.format(n, n, n) for n in range(100)]
+    assert list(tmpl.render_many(contexts, workers=2, chunksize=7)) == expected
+
+
+def test_render_many_unordered():
+    tmpl = Template('{{ n }}')
+    results = tmpl.render_many(({'n': n} for n in range(50)), workers=3, chunksize=4, ordered=False)
+    assert sorted(results, key=int) == [str(n) for n in range(50)]
+
+
+def test_render_many_loader(tmp_path):
+    with open(str(tmp_path / 'page.txt'), 'w') as f:
+        f.write('[{{ #add "row.txt" n=n }}]')
+    with open(str(tmp_path / 'row.txt'), 'w') as f:
+        f.write('{{ n }}{{ suffix }}')
+    cache = BytecodeCache(str(tmp_path / 'cache'))
+    loader = Loader(str(tmp_path), bytecode_cache=cache, locals={'suffix': '!'})
+    results = loader.render_many('page.txt', [{'n': n} for n in range(10)], workers=2)
+    assert list(results) == ['[{}!]'.format(n) for n in range(10)]
+    assert len(os.listdir(str(tmp_path / 'cache'))) == 2
+
+
+def test_render_many_error():
+    tmpl = Template('{{ x.y }}{{ x|nosuchfilter }}')
+    try:
+        list(tmpl.render_many([{'x': 1}], workers=1))
+    except KeyError:
+        pass
+    else:
+        assert False, 'expected KeyError'
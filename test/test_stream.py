@@ -0,0 +1,60 @@
+import os
+
+from misai import Loader, Template
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+tmpl_dir = os.path.join(here, 'templates')
+
+
+def test_generate():
+    t = Template('{{ #for x : items }}<{{ x }}>{{ #end }}')
+    chunks = t.generate(items=[1, 2])
+    assert next(chunks) == '<'
+    assert ''.join(chunks) == '1><2>'
+
+
+def test_stream_buffered():
+    t = Template('{{ #for x : items }}{{ x }}{{ #end }}', buffer_size=4)
+    assert list(t.stream(items='abcdefghij')) == ['abcd', 'efgh', 'ij']
+
+
+def test_stream_unbuffered():
+    t = Template('a{{ x }}b')
+    assert list(t.stream(x='-')) == ['a', '-', 'b']
+
+
+def test_stream_include():
+    loader = Loader(tmpl_dir)
+    chunks = list(loader.get('base.txt').stream(endword='!!!'))
+    assert chunks == ['one', 'two', 'three', '!!!']
+
+
+def test_render_matches_stream():
+    source = (
+        'a{{ x }}b{{ #for i : items }}[{{ i }}{{ #if i == 2 }}!{{ #end }}]{{ #end }}'
+        '{{ #set y = "z" }}{{ y }}')
+    t = Template(source)
+    params = {'x': '<', 'items': [1, 2, 3]}
+    assert t.render(**params) == ''.join(t.generate(**params)) == 'a&lt;b[1][2!][3]z'
+
+
+def test_render_include():
+    loader = Loader(tmpl_dir)
+    assert loader.get('test/foo.txt').render() == 'foobar'
+
+
+def test_render_bytes():
+    t = Template('café {{ x }}{{ #for i : items }}[{{ i }}]{{ #end }}')
+    assert t.render_bytes(x='☃', items=[1]) == 'café ☃[1]'.encode('utf-8')
+    assert Template('{{ x }}', encoding='latin-1').render_bytes(x='é') == b'\xe9'
+
+
+def test_stream_bytes():
+    t = Template('{{ #for i : items }}<{{ i }}>{{ #end }}', buffer_size=6)
+    assert list(t.stream_bytes(items=[1, 2, 3])) == [b'<1><2>', b'<3>']
+
+
+def test_stream_bytes_include():
+    loader = Loader(tmpl_dir)
+    assert loader.get('base.txt').render_bytes(endword='!') == b'onetwothree!'